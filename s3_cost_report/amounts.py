@@ -0,0 +1,132 @@
+import logging
+from decimal import ROUND_HALF_EVEN, Decimal
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# Amounts are stored as integers in units of 1e-10 dollars (a hundredth of a
+# micro-cent). Cost Explorer reports amounts with ten decimal places, so they
+# can be summed and compared exactly and only need rounding when rendered.
+PLACES = 10
+SCALE = 10**PLACES
+
+# Half a cent in scaled units, used when rounding for display
+_HALF_CENT = SCALE // 200
+_CENT = SCALE // 100
+
+# Multiplier for a decimal string, indexed by its number of decimal places
+_SHIFT = {places: 10 ** (PLACES - places) for places in range(PLACES + 1)}
+
+
+def _parse_decimal(amount):
+    """
+    Slow path for amounts that are not plain decimal strings (e.g. '1.5E-7'),
+    or that have more decimal places than we keep.
+    """
+    scaled = Decimal(amount).scaleb(PLACES)
+    return int(scaled.to_integral_value(rounding=ROUND_HALF_EVEN))
+
+
+def parse_amount(amount):
+    """
+    Convert a dollar amount string (as returned by Cost Explorer) into an
+    integer number of scaled units without going through a float.
+
+    Example: '12.3' -> 123000000000
+    """
+    dot = amount.find(".")
+    places = len(amount) - dot - 1 if dot >= 0 else 0
+    try:
+        return int(amount.replace(".", "", 1)) * _SHIFT[places]
+    except (KeyError, ValueError):
+        return _parse_decimal(amount)
+
+
+def parse_totals(results_by_time, metric, minimum=0):
+    """
+    Sum the amounts in Cost Explorer results into a flat dictionary mapping
+    each group key to its total in scaled units.
+
+    Groups with a total less than 'minimum' are skipped.
+    """
+    totals = {}
+
+    for result in results_by_time:
+        for group in result["Groups"]:
+            keys = group["Keys"]
+            if len(keys) != 1:
+                LOG.error(f"Unexpected grouping: {keys}")
+                continue
+
+            raw_amount = group["Metrics"][metric]["Amount"]
+            amount = parse_amount(raw_amount)
+            if minimum != 0 and amount < minimum:
+                LOG.warning(
+                    f"Skipping amount ({raw_amount}) less than minimum "
+                    f"({format_dollars(minimum)})"
+                )
+                continue
+
+            key = keys[0]
+            if key in totals:
+                totals[key] += amount
+            else:
+                totals[key] = amount
+
+    return totals
+
+
+def percent_change(total, compare):
+    """
+    Calculate the fractional change from 'compare' to 'total'.
+
+    Both arguments are in scaled units, so the difference is exact and only
+    the final division rounds.
+    """
+
+    # changes from zero are special cases
+    if compare == 0:
+        if total == 0:
+            # both are zero, no change
+            return 0.0
+
+        # up from zero, 100% change
+        return 1.0
+
+    return (total - compare) / compare
+
+
+def percent_changes(totals, compare):
+    """
+    Calculate the change for every key in 'totals' from the matching key in
+    'compare' (see `percent_change`); both map keys to scaled amounts. Keys
+    that are missing from 'compare' are treated as a 100% increase.
+    """
+    changes = {}
+
+    for key, total in totals.items():
+        if key in compare:
+            changes[key] = percent_change(total, compare[key])
+        else:
+            changes[key] = 1.0
+
+    return changes
+
+
+def format_dollars(amount):
+    """
+    Render an amount in scaled units as a dollar string rounded to the cent.
+
+    Rounding is half-up (away from zero), matching the Cost Explorer console.
+
+    Example: 123456789012 -> '$12.35'
+    """
+    sign = "-" if amount < 0 else ""
+    cents, remainder = divmod(abs(amount), _CENT)
+    if remainder >= _HALF_CENT:
+        cents += 1
+
+    if cents == 0:
+        sign = ""
+
+    return f"${sign}{cents // 100}.{cents % 100:02}"
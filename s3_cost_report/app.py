@@ -1,10 +1,23 @@
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 import boto3
 
-from s3_cost_report import ce, ses
+from s3_cost_report import (
+    amounts,
+    ce,
+    fetch,
+    index,
+    memory,
+    periods,
+    sections,
+    ses,
+    sinks,
+    snapshots,
+)
 
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.DEBUG)
@@ -13,185 +26,534 @@ LOG.setLevel(logging.DEBUG)
 iam_client = boto3.client("iam")
 sts_client = boto3.client("sts")
 
+# Default number of Cost Explorer queries to run at once
+CE_WORKERS = 8
+
+# Order of the rows in each cost table (see `index.ORDERS`), largest first
+TABLE_ORDER = "total"
+
+# Seconds of the lambda's run time kept back from querying Cost Explorer,
+# for saving the snapshot, rendering the report and delivering it
+REPORT_RESERVE = 30
+
+# Seconds kept back at the very end, so the lambda returns before it times out
+EXIT_RESERVE = 2
+
 
 def report_periods(today):
     """
     Calculate the time periods for cost explorer.
 
     This lambda will run at the beginning of the month, looking at the
-    previous month and comparing change to the month before that.
+    previous month and comparing change to the month before that (see
+    `periods.report_periods`).
 
     The Start date is inclusive, and the End date is exclusive
     """
-    target_period = {}
-    compare_period = {}
+    target_period, compare_period = periods.report_periods(today)
 
-    # Special-case the two cases where we cross year boundaries
-    if today.month == 1:
-        # in Jan, look at Dec and Nov of last year
-        target_period["Start"] = f"{today.year - 1}-12-01"
-        target_period["End"] = f"{today.year}-01-01"
+    LOG.info(f"Target month: {target_period}")
+    LOG.info(f"Compare month: {compare_period}")
 
-        compare_period["Start"] = f"{today.year - 1}-11-01"
-        compare_period["End"] = f"{today.year - 1}-12-01"
+    return target_period, compare_period
 
-    elif today.month == 2:
-        # in Feb, look at Jan of this year and Dec of last year
-        target_period["Start"] = f"{today.year}-01-01"
-        target_period["End"] = f"{today.year}-02-01"
 
-        compare_period["Start"] = f"{today.year - 1}-12-01"
-        compare_period["End"] = f"{today.year}-01-01"
+def forecast_period(today):
+    """
+    Calculate the time period for cost explorer forecasts: the rest of the
+    current month, starting today.
 
-    else:
-        # no year boundary, look at the previous two months
-        target_period["Start"] = f"{today.year}-{(today.month - 1):02}-01"
-        target_period["End"] = f"{today.year}-{today.month:02}-01"
+    The Start date is inclusive, and the End date is exclusive
+    """
+    return periods.forecast_period(today)
 
-        compare_period["Start"] = f"{today.year}-{(today.month - 2):02}-01"
-        compare_period["End"] = f"{today.year}-{(today.month - 1):02}-01"
 
-    LOG.info(f"Target month: {target_period}")
-    LOG.info(f"Compare month: {compare_period}")
+def parse_results_by_time(results_by_time):
+    """
+    Transform results returned from Cost Explorer into a flat dictionary
+    mapping each key to its total.
 
-    return target_period, compare_period
+    Totals are kept as exact scaled integers (see `amounts`) and summed
+    across all results for a key; rounding only happens when rendering.
+    """
+    return amounts.parse_totals(results_by_time, ce.cost_metric)
 
 
-def parse_results_by_time(results_by_time, compare=None):
+def join_totals(target_totals, compare_totals):
     """
-    Transform results returned from Cost Explorer into a useful data structure,
-    and optionally calculating change from a previous result.
+    Join the totals of the target and compare periods (see
+    `index.CostIndex`), leaving out keys under the MINIMUM env var, and
+    generate the multi-level dictionary for the report tables, sorted by
+    TABLE_ORDER.
     """
-    data = {}
-
-    minimum = float(os.environ["MINIMUM"])
+    minimum = amounts.parse_amount(os.environ["MINIMUM"])
+    costs = index.CostIndex(target_totals, compare_totals, minimum=minimum)
+    return costs.to_dict(TABLE_ORDER, reverse=True)
 
-    for result in results_by_time:
-        for group in result["Groups"]:
-            amount = float(group["Metrics"][ce.cost_metric]["Amount"])
-            if minimum != 0 and amount < minimum:
-                LOG.warning(f"Skipping amount ({amount}) less than minimum ({minimum})")
-                continue
 
-            if len(group["Keys"]) != 1:
-                LOG.error(f"Unexpected grouping: {group['Keys']}")
-                continue
+def query_totals(section, period, account_id=None):
+    """
+    Query Cost Explorer for a section's totals in one period, keyed by
+    group value.
 
-            key = group["Keys"][0]
-            data[key] = {"total": amount}
+    The raw response is parsed as soon as it arrives and not kept, so that
+    it can be freed before the next query.
+    """
+    response = ce.get_ce_costs(period, section.group_by, section.filter, account_id)
+    totals = parse_results_by_time(response["ResultsByTime"])
 
-            if compare and key in compare:
-                _total = data[key]["total"]
-                _compare = compare[key]["total"]
+    if section.group_by["Type"] != "DIMENSION":
+        totals = {section.value(key): total for key, total in totals.items()}
 
-                # changes from zero are special cases
-                if _compare == 0:
-                    if _total == 0:
-                        # both are zero, no change
-                        pct = 0
-                    else:
-                        # up from zero, 100% change
-                        pct = 1
-                else:
-                    # calculate percent change
-                    pct = (_total / _compare) - 1
-            else:
-                pct = 1.0
+    return totals
 
-            data[key]["change"] = pct
 
-    return data
+def get_section_costs(section, target_period, compare_period, account_id=None):
+    """
+    Get a section's cost information from cost explorer for both time
+    periods and generate a multi-level dictionary (see `get_service_costs`).
+    """
+    compare_totals = query_totals(section, compare_period, account_id)
+    target_totals = query_totals(section, target_period, account_id)
+    return join_totals(target_totals, compare_totals)
 
 
-def get_service_costs(target_period, compare_period):
+def get_service_costs(target_period, compare_period, account_id=None):
     """
     Get service cost information from cost explorer for both time periods
     and generate a multi-level dictionary. The top-level key will be the
     name of the AWS service being summarized, and the subkeys will be the
-    literal strings 'total' and 'change'; 'total' will map to a float
-    representing total for this service, and 'change' will map to a float
-    representing the percent change from the last month.
+    literal strings 'total' and 'change'; 'total' will map to an integer
+    (see `amounts`) representing total for this service, and 'change' will
+    map to a float representing the percent change from the last month.
+    Services that were only used in the compare period are included with a
+    zero total.
+
+    If an account ID is given, only costs for that member account of the
+    organization are included.
 
     Example:
     ```
     ec2:
-        total: 12.3
+        total: 123000000000  # $12.30
         change: -0.1
     s3:
-        total: 32.1
+        total: 321000000000  # $32.10
         change: 0.5
     ```
     """
 
-    # First generate data to compare against
-    compare_data = ce.get_ce_service_costs(compare_period)
-    compare_dict = parse_results_by_time(compare_data["ResultsByTime"])
-
-    # Then generate data our target data, passing in compare data
-    target_data = ce.get_ce_service_costs(target_period)
-    target_dict = parse_results_by_time(target_data["ResultsByTime"], compare_dict)
+    return get_section_costs(
+        sections.SERVICES, target_period, compare_period, account_id
+    )
 
-    return target_dict
 
-
-def get_s3_usage_costs(target_period, compare_period):
+def get_s3_usage_costs(target_period, compare_period, account_id=None):
     """
     Get S3 usage cost information from cost explorer for both time periods
     and generate a multi-level dictionary. The top-level key will be the
     name of the S3 usage type being summarized, and the subkeys will be the
-    literal strings 'total' and 'change'; 'total' will map to a float
-    representing total for this service, and 'change' will map to a float
-    representing the percent change from the last month.
+    literal strings 'total' and 'change'; 'total' will map to an integer
+    (see `amounts`) representing total for this usage type, and 'change'
+    will map to a float representing the percent change from the last month.
+    Usage types only seen in the compare period are included with a zero
+    total.
+
+    If an account ID is given, only costs for that member account of the
+    organization are included.
 
     Example:
     ```
     s3-bytes-out:
-        total: 100.0
+        total: 1000000000000  # $100.00
         change: 0.5
     s3-timed-storage:
-        total: 20.0
+        total: 200000000000  # $20.00
         change: -0.5
     ```
     """
 
-    compare_ce_data = ce.get_ce_s3_usage_costs(compare_period)
-    compare_dict = parse_results_by_time(compare_ce_data["ResultsByTime"])
+    return get_section_costs(
+        sections.S3_USAGE, target_period, compare_period, account_id
+    )
 
-    target_ce_data = ce.get_ce_s3_usage_costs(target_period)
-    target_dict = parse_results_by_time(target_ce_data["ResultsByTime"], compare_dict)
 
-    return target_dict
+def ce_workers():
+    """
+    Number of Cost Explorer queries to run at once, from the CE_WORKERS env
+    var (default CE_WORKERS). In low-memory mode queries run one at a time.
+    """
+    if memory.low_memory():
+        return 1
+    return int(os.environ.get("CE_WORKERS", CE_WORKERS))
 
 
-def lambda_handler(event, context):
+def make_fetcher(deadline=None):
     """
-    Entry point
+    Create a fetcher for Cost Explorer queries that must finish by the
+    deadline (see `fetch.Fetcher`).
 
-    Send monthly email reports to STRIDES admins with monthly totals for
-    (1) each AWS service, and (2) each S3 usage type.Include month-over-month
-    changes for both service and usage-type totals.
+    In low-memory mode slow queries are not hedged, and only one query runs
+    at a time, so that only one raw response is held in memory at once.
+    """
+    if memory.low_memory():
+        return fetch.Fetcher(deadline, hedge_after=None, workers=1)
+    return fetch.Fetcher(deadline, workers=2 * ce_workers())
+
+
+def submit_forecasts(pool, fetcher, period, section, data, account_id=None):
+    """
+    Submit a forecast query to the pool for each key in a section's data
+    with a non-zero total, since Cost Explorer forecasts can't be grouped.
+    """
+    return {
+        key: pool.submit(
+            fetcher.call,
+            ce.get_ce_forecast,
+            period,
+            ce.with_account(section.forecast_filter(key), account_id),
+        )
+        for key in data
+        if data[key]["total"] != 0
+    }
+
+
+def add_forecasts(data, futures, fetcher):
+    """
+    Add the results of forecast queries to the data under 'forecast',
+    skipping any that fail or don't finish by the fetcher's deadline.
+    """
+    for key, future in futures.items():
+        try:
+            amount = future.result(timeout=fetcher.remaining())
+        except Exception as e:
+            LOG.warning(f"No forecast for {key}: {e!r}")
+            continue
+
+        if amount is not None:
+            data[key]["forecast"] = amounts.parse_amount(amount)
+
+
+def get_report_data(
+    target_period,
+    compare_period,
+    forecast=None,
+    account_id=None,
+    report_sections=sections.DEFAULT_SECTIONS,
+    fetcher=None,
+    compare_totals=None,
+):
+    """
+    Get the cost breakdown for each report section (see `sections`),
+    optionally for a single member account, as a dictionary mapping each
+    section name to a multi-level dictionary (see `get_service_costs`).
+
+    The target and compare period queries for every section are submitted
+    together and run concurrently. Each section is joined as soon as both
+    its periods are ready, and if a forecast period is given, its forecasts
+    are queried straight away, in parallel with any queries still running.
+
+    Queries run through the fetcher (see `make_fetcher`), which retries and
+    hedges them within its deadline. Sections whose queries fail or don't
+    finish in time are left out, so that the rest of the report can still
+    be sent.
+
+    Sections with known totals for the compare period, in 'compare_totals'
+    (e.g. from the snapshot of the last report, see `load_compare_totals`),
+    only query the target period.
+
+    In low-memory mode the queries run one at a time instead, so that only
+    one raw response is held in memory at once.
+    """
+    own_fetcher = fetcher is None
+    if own_fetcher:
+        fetcher = make_fetcher()
+
+    totals = {section.name: {} for section in report_sections}
+    for name, known in (compare_totals or {}).items():
+        if name in totals:
+            totals[name][1] = known
+    data = {}
+    forecasts = {}
+
+    pool = ThreadPoolExecutor(max_workers=ce_workers())
+    try:
+        futures = {}
+        for section in report_sections:
+            for i, period in enumerate((target_period, compare_period)):
+                if i in totals[section.name]:
+                    continue
+                args = (query_totals, section, period, account_id)
+                futures[pool.submit(fetcher.call, *args)] = (section, i)
+
+        try:
+            for future in as_completed(futures, timeout=fetcher.remaining()):
+                section, i = futures[future]
+                if section.name not in totals:
+                    continue  # the other period already failed
+
+                try:
+                    totals[section.name][i] = future.result()
+                except Exception as e:
+                    LOG.error(f"Failed to get {section.name} costs: {e!r}")
+                    del totals[section.name]
+                    continue
+
+                if len(totals[section.name]) < 2:
+                    continue
+
+                period_totals = totals.pop(section.name)
+                data[section.name] = join_totals(period_totals[0], period_totals[1])
+
+                if forecast is not None:
+                    forecasts[section.name] = submit_forecasts(
+                        pool, fetcher, forecast, section, data[section.name], account_id
+                    )
+        except TimeoutError:
+            LOG.error(f"Ran out of time for Cost Explorer queries: {list(totals)}")
+
+        for name, pending in forecasts.items():
+            add_forecasts(data[name], pending, fetcher)
+
+    finally:
+        # Don't wait for queries that overran the deadline
+        pool.shutdown(wait=False, cancel_futures=True)
+        if own_fetcher:
+            fetcher.close()
+
+    # Keep the configured section order
+    return {
+        section.name: data[section.name]
+        for section in report_sections
+        if section.name in data
+    }
+
+
+def load_compare_totals(compare_period):
     """
+    Load the totals of each section for the compare period from the snapshot
+    of that period's report, if a snapshot store is configured and has one,
+    so that they don't have to be queried again.
 
-    # Get account name (default to ID if no Alias is set)
+    Returns a dictionary of totals keyed by section name, or {} if there is
+    no snapshot to use.
+    """
+    store = snapshots.from_environment()
+    if store is None:
+        return {}
+
+    try:
+        snapshot = store.load(compare_period)
+    except Exception as e:
+        LOG.error(f"Failed to load the compare period snapshot: {e!r}")
+        return {}
+
+    if snapshot is None:
+        LOG.info("No snapshot of the compare period, querying Cost Explorer")
+        return {}
+
+    LOG.info(f"Using compare period totals from snapshot {compare_period['Start']}")
+    return snapshot[1]
+
+
+def compare_snapshots(target_period, data, complete=True):
+    """
+    Save a snapshot of this report's totals, if a snapshot store is
+    configured, replacing the snapshot saved by any earlier run for the same
+    target period, and compare them against it to find totals that Cost
+    Explorer has restated since. Partial reports, missing some sections, are
+    compared but not saved.
+
+    Returns a tuple of the target period and the changes since the earlier
+    run (see `snapshots.diff_sections`), or (None, None) if there is nothing
+    to compare against. Snapshots are optional, so errors from the store are
+    logged rather than raised.
+    """
+    store = snapshots.from_environment()
+    if store is None:
+        return None, None
+
+    totals = {
+        name: {key: value["total"] for key, value in costs.items()}
+        for name, costs in data.items()
+    }
+
+    try:
+        previous = store.load(target_period)
+    except Exception as e:
+        LOG.error(f"Failed to load the last report snapshot: {e!r}")
+        previous = None
+
+    if complete:
+        try:
+            store.save(target_period, totals)
+        except Exception as e:
+            LOG.error(f"Failed to save a report snapshot: {e!r}")
+    else:
+        LOG.warning("Not saving a snapshot of a partial report")
+
+    if previous is None:
+        LOG.info("No earlier report snapshot for this period found")
+        return None, None
+
+    previous_period, previous_sections = previous
+    return previous_period, snapshots.diff_sections(totals, previous_sections)
+
+
+def load_last_known(target_period, names):
+    """
+    Load the last known totals for sections that could not be fetched, if
+    a snapshot store is configured: from the snapshot of the target period
+    if an earlier run saved one, or else from the most recent earlier
+    snapshot.
+
+    Returns a tuple of the snapshot's target period and a dictionary of
+    totals for each of the named sections it has, or (None, {}) if there
+    is no snapshot to use.
+    """
+    store = snapshots.from_environment()
+    if store is None:
+        return None, {}
+
+    try:
+        snapshot = store.load(target_period) or store.latest(target_period)
+    except Exception as e:
+        LOG.error(f"Failed to load last known totals: {e!r}")
+        return None, {}
+
+    if snapshot is None:
+        return None, {}
+
+    period, totals = snapshot
+    return period, {name: totals[name] for name in names if name in totals}
+
+
+def get_account_name():
+    """
+    Get the name of this account, the account alias if it has one or the
+    account ID otherwise.
+    """
     account = sts_client.get_caller_identity()['Account']
     aliases = iam_client.list_account_aliases()['AccountAliases']
     # aliases will have at most one element
     if len(aliases) > 0:
         account = aliases[0]
 
-    # Calculate the reporting periods to send to cost explorer
-    now = datetime.now()
-    target_month, compare_month = report_periods(now)
+    return account
+
 
-    # Build email summary
-    per_service = get_service_costs(target_month, compare_month)
-    s3_usage = get_s3_usage_costs(target_month, compare_month)
+def build_report(
+    account, today, account_id=None, forecast=False, snapshot=True, deadline=None
+):
+    """
+    Run the report pipeline for the month before 'today' and render it.
+
+    If an account ID is given the report only covers that member account.
+    Forecasts for the current month are optional. With snapshots enabled,
+    the compare period's totals are taken from the last report's snapshot
+    when there is one, and totals restated since an earlier report for the
+    same period are listed.
+
+    Cost Explorer queries must finish by the deadline, a time.monotonic()
+    value (or None for no deadline). Sections that can't be fetched in time
+    are shown with their last known totals from a snapshot, if there is
+    one, and the report is marked as partial.
+    """
+
+    # Calculate the reporting periods to send to cost explorer
+    target_month, compare_month = report_periods(today)
+
+    # Forecasts for the current month are optional, since each one is a
+    # separate (billed) Cost Explorer query
+    forecast_month = None
+    if forecast:
+        forecast_month = forecast_period(today)
+
+    # Build email summary, reusing the last report's totals for the compare
+    # period if they were saved
+    report_sections = sections.from_environment()
+    compare_totals = {}
+    if snapshot:
+        compare_totals = load_compare_totals(compare_month)
+    with memory.stage("fetch"):
+        with make_fetcher(deadline) as fetcher:
+            data = get_report_data(
+                target_month,
+                compare_month,
+                forecast_month,
+                account_id,
+                report_sections,
+                fetcher,
+                compare_totals,
+            )
+    missing = [section.name for section in report_sections if section.name not in data]
+
+    # Compare against an earlier report for the same period, and fill in any
+    # missing sections from the last stored report
+    last_period, last_changes = None, None
+    stale_period, stale = None, {}
+    if snapshot:
+        with memory.stage("snapshot"):
+            last_period, last_changes = compare_snapshots(
+                target_month, data, complete=not missing
+            )
+            if missing:
+                stale_period, stale = load_last_known(target_month, missing)
 
     # Name of the target period for the email subject
     _dt = datetime.fromisoformat(target_month["Start"])
     email_period = _dt.strftime("%B %Y")  # Month Year
     email_subject = f"AWS Monthly Cost Report ({account} {email_period})"
+    if missing:
+        email_subject = f"{email_subject} [partial]"
+
+    with memory.stage("render"):
+        email_html, email_text = ses.build_report_body(
+            account,
+            report_sections,
+            data,
+            last_period,
+            last_changes,
+            stale_period,
+            stale,
+        )
+    return sinks.Report(target_month["Start"], email_subject, email_html, email_text)
+
+
+def lambda_handler(event, context):
+    """
+    Entry point
+
+    Send monthly email reports to STRIDES admins with monthly totals for
+    (1) each AWS service, and (2) each S3 usage type.Include month-over-month
+    changes for both service and usage-type totals, and for any other
+    configured sections (see `sections`).
+
+    Cost Explorer queries are given the run time remaining, less enough to
+    render and deliver the report, so that a partial report still goes out
+    when Cost Explorer is slow or throttled. Raises an error if the report
+    could not be delivered to any output.
+    """
+
+    # Time limits for the run, from the lambda's timeout
+    end = time.monotonic() + context.get_remaining_time_in_millis() / 1000
+    fetch_deadline = end - REPORT_RESERVE
+    dispatch_deadline = end - EXIT_RESERVE
+
+    account = get_account_name()
+    forecast = os.environ.get("FORECAST", "false").lower() == "true"
+
+    # Create the report and send it to every configured output; in
+    # low-memory mode, track the peak memory of each stage
+    with memory.tracking():
+        report = build_report(
+            account, datetime.now(), forecast=forecast, deadline=fetch_deadline
+        )
+
+        with memory.stage("dispatch"):
+            results = sinks.dispatch(
+                sinks.from_environment(), report, dispatch_deadline
+            )
 
-    # Create and send report
-    email_html, email_text = ses.build_email_body(account, per_service, s3_usage)
-    ses.send_email(email_subject, email_html, email_text)
+    if results and not any(result is True for result in results.values()):
+        raise RuntimeError("Failed to deliver the report to any output")
@@ -1,4 +1,7 @@
+import json
 import logging
+import threading
+from datetime import date
 
 import boto3
 from botocore.config import Config as BotoConfig
@@ -8,20 +11,121 @@ LOG.setLevel(logging.DEBUG)
 
 cost_metric = "NetAmortizedCost"
 
-# Use adaptive mode in an attempt to optimize retry back-off
+# The forecast API spells metrics differently
+forecast_metric = "NET_AMORTIZED_COST"
+
+s3_service_filter = {
+    "Dimensions": {
+        "Key": "SERVICE",
+        "Values": [
+            "Amazon Simple Storage Service",
+        ],
+        "MatchOptions": ["EQUALS"],
+    }
+}
+
+service_group = {"Type": "DIMENSION", "Key": "SERVICE"}
+
+usage_type_group = {"Type": "DIMENSION", "Key": "USAGE_TYPE"}
+
+# Use adaptive mode for its client-side rate limiting, and time out a hung
+# request rather than let it use up the lambda's run time. Retries are left
+# to the fetch layer (see `fetch.Fetcher`), so that retries don't multiply
+# the billed requests sent while Cost Explorer is throttling.
 ce_config = BotoConfig(
+    connect_timeout=5,
+    read_timeout=20,
     retries={
         "mode": "adaptive",  # default mode is legacy
+        "total_max_attempts": 1,  # a single attempt, without retries
     }
 )
 ce_client = boto3.client("ce", config=ce_config)
 
 
-def get_ce_service_costs(period):
+def linked_account_filter(account_id):
+    """
+    Filter for a single member account of an organization
+    """
+    return {
+        "Dimensions": {
+            "Key": "LINKED_ACCOUNT",
+            "Values": [account_id],
+            "MatchOptions": ["EQUALS"],
+        }
+    }
+
+
+def and_filters(*filters):
+    """
+    Combine filters (any of which may be None) so that all must match.
+    Returns None if there are no filters.
+    """
+    filters = [f for f in filters if f is not None]
+    if not filters:
+        return None
+    if len(filters) == 1:
+        return filters[0]
+    return {"And": filters}
+
+
+def with_account(cost_filter, account_id=None):
+    """
+    Restrict a filter (which may be None) to a member account, if one is
+    given; otherwise the filter is returned unchanged.
+    """
+    if account_id is None:
+        return cost_filter
+
+    return and_filters(cost_filter, linked_account_filter(account_id))
+
+
+# Filter expression names for each type of group
+_group_filter_types = {
+    "DIMENSION": "Dimensions",
+    "TAG": "Tags",
+    "COST_CATEGORY": "CostCategories",
+}
+
+
+def group_value(group_by, key):
+    """
+    Get the value of a group from its key in a Cost Explorer response.
+    Tag and cost category keys are returned as 'Key$value', so strip the
+    prefix; dimension keys are already the value.
+    """
+    if group_by["Type"] == "DIMENSION":
+        return key
+    return key.split("$", 1)[-1]
+
+
+def group_filter(group_by, value):
+    """
+    Filter for a single group value, e.g. one service when grouping by the
+    SERVICE dimension, or one value of a tag. An empty tag or cost category
+    value matches resources without it.
+    """
+    expression = {"Key": group_by["Key"]}
+    if value == "" and group_by["Type"] != "DIMENSION":
+        expression["MatchOptions"] = ["ABSENT"]
+    else:
+        expression["Values"] = [value]
+        expression["MatchOptions"] = ["EQUALS"]
+
+    return {_group_filter_types[group_by["Type"]]: expression}
+
+
+def get_ce_costs(period, group_by, cost_filter=None, account_id=None):
     """
-    Get totals grouped by AWS service
+    Get totals grouped by a dimension, tag or cost category, optionally
+    filtered and for a single member account
     """
 
+    kwargs = {}
+    cost_filter = with_account(cost_filter, account_id)
+    if cost_filter is not None:
+        kwargs["Filter"] = cost_filter
+
     response = ce_client.get_cost_and_usage(
         TimePeriod=period,
         Granularity="MONTHLY",
@@ -29,42 +133,74 @@ def get_ce_service_costs(period):
             cost_metric,
         ],
         GroupBy=[
-            {
-                "Type": "DIMENSION",
-                "Key": "SERVICE",
-            }
+            group_by,
         ],
+        **kwargs,
     )
 
     return response
 
 
-def get_ce_s3_usage_costs(period):
+def get_ce_service_costs(period, account_id=None):
     """
-    Get totals for S3 grouped by usage type
+    Get totals grouped by AWS service, optionally for a single member account
     """
+    return get_ce_costs(period, service_group, account_id=account_id)
 
-    response = ce_client.get_cost_and_usage(
-        TimePeriod=period,
-        Granularity="MONTHLY",
-        Metrics=[
-            cost_metric,
-        ],
-        Filter={
-            "Dimensions": {
-                "Key": "SERVICE",
-                "Values": [
-                    "Amazon Simple Storage Service",
-                ],
-                "MatchOptions": ["EQUALS"],
-            }
-        },
-        GroupBy=[
-            {
-                "Type": "DIMENSION",
-                "Key": "USAGE_TYPE",
-            }
-        ],
+
+def get_ce_s3_usage_costs(period, account_id=None):
+    """
+    Get totals for S3 grouped by usage type, optionally for a single member
+    account
+    """
+    return get_ce_costs(period, usage_type_group, s3_service_filter, account_id)
+
+
+# Forecasts cached for the day, keyed by date and filter, so that repeated
+# invocations of a warm container don't pay for them again. Only today's
+# forecasts are kept. Forecasts are queried from several threads at once, so
+# the cache is only used with the lock held.
+_forecast_cache = {}
+_forecast_lock = threading.Lock()
+
+
+def get_ce_forecast(period, cost_filter=None):
+    """
+    Get the forecast total for the period, optionally filtered.
+
+    Returns the forecast amount string, or None if Cost Explorer does not
+    have enough data to make a forecast. Other errors are raised, so that
+    the caller can retry them (see `fetch.Fetcher`).
+    """
+
+    today = date.today().isoformat()
+    cache_key = (
+        today,
+        json.dumps([period, cost_filter], sort_keys=True),
     )
+    with _forecast_lock:
+        if cache_key in _forecast_cache:
+            return _forecast_cache[cache_key]
 
-    return response
+    kwargs = {}
+    if cost_filter is not None:
+        kwargs["Filter"] = cost_filter
+
+    try:
+        response = ce_client.get_cost_forecast(
+            TimePeriod=period,
+            Granularity="MONTHLY",
+            Metric=forecast_metric,
+            **kwargs,
+        )
+        amount = response["Total"]["Amount"]
+    except ce_client.exceptions.DataUnavailableException:
+        # Too little history to forecast, which won't change today
+        LOG.info(f"No forecast data available for {cost_filter}")
+        amount = None
+
+    with _forecast_lock:
+        for key in [key for key in _forecast_cache if key[0] != today]:
+            del _forecast_cache[key]
+        _forecast_cache[cache_key] = amount
+    return amount
@@ -0,0 +1,243 @@
+"""
+Generate cost reports from the command line.
+
+Runs the same pipeline as the lambda for any number of member accounts and
+months, spreading the reports across a pool of processes, and writes the
+rendered HTML and plain-text reports to disk instead of sending them.
+
+Example, a year of reports for two member accounts:
+```
+python -m s3_cost_report.cli --start 2023-01 --end 2023-12 \\
+    --account 111111111111:dev --account 222222222222:prod \\
+    --output-dir reports
+```
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+from pathlib import Path
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# One report to generate: the member account (None for the whole
+# organization or account), its display name, and the target month
+Job = namedtuple("Job", ["account_id", "account", "month"])
+
+# Seconds allowed for writing each report to disk
+WRITE_TIMEOUT = 30
+
+# Cost Explorer queries each worker process runs at once, when there is more
+# than one process, so that the processes together stay under the rate limit
+BATCH_CE_WORKERS = 1
+
+
+def configure_logging():
+    """
+    Log progress at INFO level to stderr, in the main and worker processes.
+
+    The package's loggers are set to DEBUG for the lambda, so the handler
+    filters by level too; otherwise whole report bodies would be logged.
+    """
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.INFO)
+    logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[handler])
+
+
+def parse_month(value):
+    """
+    Parse a 'YYYY-MM' string into the first day of that month.
+    """
+    try:
+        year, month = value.split("-")
+        return date(int(year), int(month), 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected a month as YYYY-MM: {value}")
+
+
+def parse_account(value):
+    """
+    Parse an 'ID' or 'ID:name' string into an account ID and display name.
+    """
+    account_id, _, name = value.partition(":")
+    return account_id, name or account_id
+
+
+def month_range(start, end):
+    """
+    List the first day of every month from start to end, inclusive.
+    """
+    months = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        months.append(date(year, month, 1))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def build_jobs(accounts, months, account_name):
+    """
+    List a job for every combination of account and month. With no
+    accounts, report on the whole account under 'account_name'.
+    """
+    if not accounts:
+        accounts = [(None, account_name)]
+
+    return [
+        Job(account_id, account, month)
+        for account_id, account in accounts
+        for month in months
+    ]
+
+
+def run_job(job, output_dir):
+    """
+    Generate one report and write it to the output directory, returning the
+    job and the seconds it took.
+    """
+
+    # Imported here so that worker processes create their own AWS clients
+    from s3_cost_report import app, periods, sinks, snapshots
+
+    start = time.monotonic()
+
+    # The report covers the month before the day it runs
+    today = date.fromisoformat(periods.period(job.month)["End"])
+
+    report = app.build_report(job.account, today, job.account_id, snapshot=False)
+
+    store = snapshots.FileStore(Path(output_dir) / job.account)
+    sinks.StoreSink(store).deliver(report, time.monotonic() + WRITE_TIMEOUT)
+
+    return job, time.monotonic() - start
+
+
+def _check_result(job, get_result):
+    """
+    Log the outcome of a job, returning False if it failed.
+    """
+    try:
+        _, elapsed = get_result()
+    except Exception as e:
+        LOG.error(f"Failed {job.account} {job.month:%Y-%m}: {e}")
+        return False
+
+    LOG.info(f"Generated {job.account} {job.month:%Y-%m} in {elapsed:.1f}s")
+    return True
+
+
+def run_jobs(jobs, output_dir, workers, job_func=run_job):
+    """
+    Run the jobs, in a pool of worker processes if there is more than one
+    worker, and return the failed jobs.
+    """
+    if workers <= 1:
+        return [
+            job
+            for job in jobs
+            if not _check_result(job, lambda: job_func(job, output_dir))
+        ]
+
+    # Spawn fresh processes rather than forking, since boto3 clients are
+    # not safe to share across a fork. Spawned processes don't inherit the
+    # logging configuration, so each one sets it up again.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=context, initializer=configure_logging
+    ) as pool:
+        futures = {pool.submit(job_func, job, output_dir): job for job in jobs}
+        return [
+            futures[future]
+            for future in as_completed(futures)
+            if not _check_result(futures[future], future.result)
+        ]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate monthly AWS cost reports to disk"
+    )
+    parser.add_argument(
+        "--start", type=parse_month, required=True, help="First month (YYYY-MM)"
+    )
+    parser.add_argument(
+        "--end", type=parse_month, help="Last month (YYYY-MM), default: --start"
+    )
+    parser.add_argument(
+        "--account",
+        type=parse_account,
+        action="append",
+        default=[],
+        help=(
+            "Member account to report on, as ID or ID:name; may be repeated. "
+            "Default: the whole account"
+        ),
+    )
+    parser.add_argument(
+        "--output-dir", type=Path, default=Path("reports"), help="Default: reports"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes, default: number of CPUs",
+    )
+    parser.add_argument(
+        "--ce-workers",
+        type=int,
+        help=(
+            "Number of Cost Explorer queries each worker process runs at once, "
+            f"default: {BATCH_CE_WORKERS} with more than one worker process"
+        ),
+    )
+    parser.add_argument(
+        "--minimum",
+        default=os.environ.get("MINIMUM", "0.01"),
+        help="Omit totals less than this amount, default: 0.01",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    configure_logging()
+    args = parse_args(argv)
+
+    # Worker processes inherit the environment
+    os.environ["MINIMUM"] = args.minimum
+    if args.ce_workers is not None:
+        os.environ["CE_WORKERS"] = str(args.ce_workers)
+    elif args.workers > 1:
+        os.environ["CE_WORKERS"] = str(BATCH_CE_WORKERS)
+
+    months = month_range(args.start, args.end or args.start)
+
+    account_name = None
+    if not args.account:
+        from s3_cost_report import app
+
+        account_name = app.get_account_name()
+
+    jobs = build_jobs(args.account, months, account_name)
+
+    start = time.monotonic()
+    failed = run_jobs(jobs, args.output_dir, args.workers)
+    elapsed = time.monotonic() - start
+
+    done = len(jobs) - len(failed)
+    LOG.info(
+        f"Generated {done} of {len(jobs)} reports in {elapsed:.1f}s "
+        f"({done / max(elapsed, 0.001):.2f} reports/s) in {args.output_dir}"
+    )
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
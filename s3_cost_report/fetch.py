@@ -0,0 +1,267 @@
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# Seconds to wait for a query before sending a second, hedged copy of it
+HEDGE_AFTER = 10
+
+# Seconds allowed for any one query, including retries
+QUERY_TIMEOUT = 45
+
+# Error codes for requests over the rate limit
+THROTTLING_CODES = {
+    "LimitExceededException",
+    "RequestLimitExceeded",
+    "ThrottlingException",
+    "Throttling",
+}
+
+# Error codes worth retrying: throttling and transient service errors
+RETRYABLE_CODES = THROTTLING_CODES | {
+    "ServiceUnavailable",
+    "InternalServerError",
+}
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a service while its circuit is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stop calling a service that keeps failing.
+
+    After 'threshold' failures in a row the circuit opens, and calls fail
+    straight away for 'reset_after' seconds. Then a single trial call is let
+    through, which closes the circuit again if it succeeds.
+    """
+
+    def __init__(self, threshold=5, reset_after=30):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """
+        Whether a call may go ahead.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+
+            waited = time.monotonic() - self.opened_at
+            if waited >= self.reset_after and not self._trial:
+                self._trial = True
+                return True
+
+            return False
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                LOG.info("Circuit closed")
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    LOG.warning(f"Circuit opened after {self.failures} failures")
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """
+        End a trial call that neither succeeded nor failed, e.g. one with a
+        non-retryable error, so that a later call can be the trial.
+        """
+        with self._lock:
+            self._trial = False
+
+    def reset(self):
+        self.success()
+
+
+# Shared by all Cost Explorer queries, and kept across invocations of a
+# warm container so that a throttled account isn't hammered on every run
+ce_breaker = CircuitBreaker()
+
+
+def throttled(error):
+    """
+    Whether a query failed for going over the rate limit.
+    """
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code") in THROTTLING_CODES
+    return False
+
+
+def retryable(error):
+    """
+    Whether a failed query is worth trying again: throttling, server errors,
+    connection errors and timeouts.
+    """
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code")
+        metadata = error.response.get("ResponseMetadata", {})
+        return code in RETRYABLE_CODES or metadata.get("HTTPStatusCode", 0) >= 500
+
+    return isinstance(error, (BotoCoreError, TimeoutError))
+
+
+class Fetcher:
+    """
+    Run queries within a deadline.
+
+    Each query gets the sooner of the overall deadline (a time.monotonic()
+    value, or None for no deadline) and its own 'query_timeout'. A query
+    that hasn't returned after 'hedge_after' seconds is sent again, and
+    whichever copy returns first is used. Retryable failures (see
+    `retryable`) are retried with exponential back-off while there is
+    time left, and counted by the circuit breaker. Once a query has been
+    throttled its retries are not hedged, so as not to add to the load.
+
+    The fetcher is the only layer that retries: the Cost Explorer client
+    makes a single attempt per request (see `ce.ce_config`).
+
+    Queries run on the fetcher's own threads, so that a query that overruns
+    its deadline can be abandoned; call `close` when done.
+    """
+
+    def __init__(
+        self,
+        deadline=None,
+        hedge_after=HEDGE_AFTER,
+        query_timeout=QUERY_TIMEOUT,
+        retries=2,
+        backoff=1.0,
+        breaker=None,
+        workers=16,
+    ):
+        self.deadline = deadline
+        self.hedge_after = hedge_after
+        self.query_timeout = query_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or ce_breaker
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="fetch")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Stop the fetcher's threads, without waiting for abandoned queries.
+        """
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def remaining(self, deadline=None):
+        """
+        Seconds left until the deadline (the overall deadline by default),
+        or None if there is no deadline.
+        """
+        if deadline is None:
+            deadline = self.deadline
+        if deadline is None:
+            return None
+        return max(deadline - time.monotonic(), 0)
+
+    def _query_deadline(self):
+        if self.query_timeout is None:
+            return self.deadline
+
+        deadline = time.monotonic() + self.query_timeout
+        if self.deadline is None:
+            return deadline
+        return min(deadline, self.deadline)
+
+    def _hedged(self, deadline, hedge, func, *args):
+        """
+        Run a query, hedging it once if it is slow (and 'hedge' is set),
+        and return the first successful result.
+        """
+        futures = {self.pool.submit(func, *args)}
+        hedged = not hedge or self.hedge_after is None
+
+        while True:
+            timeout = self.remaining(deadline)
+            if not hedged and (timeout is None or timeout > self.hedge_after):
+                timeout = self.hedge_after
+
+            done, futures = wait(futures, timeout, return_when=FIRST_COMPLETED)
+
+            errors = []
+            for future in done:
+                if future.exception() is None:
+                    for other in futures:
+                        other.cancel()
+                    return future.result()
+                errors.append(future.exception())
+
+            if errors and not futures:
+                raise errors[0]
+
+            if not done:
+                if hedged or self.remaining(deadline) == 0:
+                    raise TimeoutError(f"{func.__name__} timed out")
+
+                LOG.info(f"Hedging slow query {func.__name__}")
+                futures.add(self.pool.submit(func, *args))
+                hedged = True
+
+    def call(self, func, *args):
+        """
+        Run a query, returning its result or raising its last error. Raises
+        CircuitOpenError if the circuit is open, and TimeoutError if the
+        query runs out of time.
+        """
+        deadline = self._query_deadline()
+
+        attempt = 0
+        hedge = True
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"Circuit open, skipped {func.__name__}")
+
+            try:
+                result = self._hedged(deadline, hedge, func, *args)
+            except Exception as e:
+                if not retryable(e):
+                    self.breaker.release()
+                    raise
+                self.breaker.failure()
+                if throttled(e):
+                    hedge = False
+
+                delay = self.backoff * 2**attempt
+                attempt += 1
+                remaining = self.remaining(deadline)
+                out_of_time = remaining is not None and delay >= remaining
+                if attempt > self.retries or out_of_time:
+                    raise
+                LOG.warning(f"Retrying {func.__name__} after error: {e}")
+                time.sleep(delay)
+            else:
+                self.breaker.success()
+                return result
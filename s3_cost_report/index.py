@@ -0,0 +1,114 @@
+import logging
+from collections import namedtuple
+
+from s3_cost_report import amounts
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# One joined row: the key, its total for each period (target first, then
+# compare, then any history; zero where the key is missing), the change from
+# the compare period, and the absolute difference from the compare period.
+Row = namedtuple("Row", ["key", "totals", "change", "delta"])
+
+# Supported sort orders and the row value they sort on
+ORDERS = {
+    "key": lambda row: row.key,
+    "total": lambda row: row.totals[0],
+    "delta": lambda row: row.delta,
+}
+
+
+class CostIndex:
+    """
+    Month-over-month index of cost totals.
+
+    Built once per run from flat totals (key -> scaled amount, as returned by
+    `amounts.parse_totals`) for the target period, the compare period, and
+    optionally any number of older periods. The target and compare periods
+    are aligned by key as a full outer join, so keys that only appear in the
+    compare period (e.g. a service that was not used this month) are
+    included with a zero total. Older periods are joined on those keys.
+
+    Keys with a target total less than 'minimum' are left out after the
+    join, so their changes are still worked out from the full totals. Keys
+    only in the compare period are kept if they were over the minimum then.
+    """
+
+    def __init__(self, target, compare=None, history=(), minimum=0):
+        compare = compare or {}
+        periods = [target, compare, *history]
+        self.period_count = len(periods)
+
+        # Keys in the order they are first seen, target period first
+        keys = dict.fromkeys(target)
+        keys.update(dict.fromkeys(compare))
+
+        totals = [[period.get(key, 0) for key in keys] for period in periods]
+
+        # Keys new in the target period are missing from the compare totals,
+        # so they show as a 100% increase
+        changes = amounts.percent_changes(dict(zip(keys, totals[0])), compare)
+
+        self._rows = {
+            key: Row(key, row_totals, changes[key], row_totals[0] - row_totals[1])
+            for key, row_totals in zip(keys, zip(*totals))
+        }
+
+        if minimum != 0:
+            for key in keys:
+                total = target[key] if key in target else compare[key]
+                if total < minimum:
+                    LOG.warning(
+                        f"Skipping {key} ({amounts.format_dollars(total)}) less "
+                        f"than minimum ({amounts.format_dollars(minimum)})"
+                    )
+                    del self._rows[key]
+
+        # Sorted key lists, computed on first use and shared by every table
+        self._orders = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __getitem__(self, key):
+        return self._rows[key]
+
+    def keys(self, order=None, reverse=False):
+        """
+        List the keys in the given order (see `ORDERS`), or in the order
+        they were first seen if no order is given.
+        """
+        if order is None:
+            return list(self._rows)
+
+        if (order, reverse) not in self._orders:
+            rows = sorted(self._rows.values(), key=ORDERS[order], reverse=reverse)
+            self._orders[(order, reverse)] = [row.key for row in rows]
+
+        return self._orders[(order, reverse)]
+
+    def rows(self, order=None, reverse=False):
+        """
+        Iterate over the joined rows in the given order.
+        """
+        for key in self.keys(order, reverse):
+            yield self._rows[key]
+
+    def to_dict(self, order=None, reverse=False):
+        """
+        Generate the multi-level dictionary used to build report tables,
+        mapping each key to its 'total' and 'change', in the given order.
+
+        Keys that were missing from the compare period show a 100% increase,
+        and keys that are missing from the target period a 100% decrease.
+        """
+        data = {}
+
+        for row in self.rows(order, reverse):
+            data[row.key] = {"total": row.totals[0], "change": row.change}
+
+        return data
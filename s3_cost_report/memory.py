@@ -0,0 +1,107 @@
+import logging
+import os
+import resource
+import tracemalloc
+from contextlib import contextmanager
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# Longest email body rendered in low-memory mode, in characters
+BODY_LIMIT = 1_000_000
+
+# Longest email body logged at debug level in low-memory mode, in characters
+DEBUG_LOG_LIMIT = 2_000
+
+# Default ceiling on peak traced memory before warning, in MB
+DEFAULT_CEILING_MB = 64
+
+# Peak traced memory in bytes for each stage of the last tracked run
+peaks = {}
+
+
+def low_memory():
+    """
+    Whether low-memory mode is enabled with the LOW_MEMORY env var.
+
+    In low-memory mode Cost Explorer queries run one at a time so that only
+    one raw response is held at once, email bodies are capped at
+    BODY_LIMIT characters, debug logging of the bodies is truncated, and the
+    peak memory of each stage is tracked and logged.
+    """
+    return os.environ.get("LOW_MEMORY", "false").lower() == "true"
+
+
+def ceiling():
+    """
+    Ceiling on peak traced memory in bytes, from the MEMORY_CEILING_MB env
+    var.
+    """
+    return float(os.environ.get("MEMORY_CEILING_MB", DEFAULT_CEILING_MB)) * 2**20
+
+
+def body_limit():
+    """
+    Limit on the length of a rendered email body, or None for no limit.
+    """
+    return BODY_LIMIT if low_memory() else None
+
+
+def log_preview(text):
+    """
+    Shorten text for debug logging in low-memory mode.
+    """
+    if not low_memory() or len(text) <= DEBUG_LOG_LIMIT:
+        return text
+    return f"{text[:DEBUG_LOG_LIMIT]}... ({len(text)} characters)"
+
+
+@contextmanager
+def tracking(enabled=None):
+    """
+    Trace memory allocations for a run, so that `stage` can report the peak
+    of each stage. Enabled in low-memory mode by default.
+    """
+    if enabled is None:
+        enabled = low_memory()
+
+    if not enabled or tracemalloc.is_tracing():
+        yield
+        return
+
+    peaks.clear()
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        tracemalloc.stop()
+
+
+@contextmanager
+def stage(name):
+    """
+    Record and log the peak traced memory while a stage runs, along with
+    the peak RSS of the process so far. Does nothing unless tracking.
+    """
+    if not tracemalloc.is_tracing():
+        yield
+        return
+
+    tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        _, peak = tracemalloc.get_traced_memory()
+        peaks[name] = peak
+
+        # ru_maxrss is in kilobytes on Linux
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+        message = (
+            f"Stage {name}: peak traced memory {peak / 2**20:.1f} MB, "
+            f"max RSS {max_rss / 2**20:.1f} MB"
+        )
+        if peak > ceiling():
+            LOG.warning(f"{message}, over ceiling of {ceiling() / 2**20:.0f} MB")
+        else:
+            LOG.info(message)
@@ -0,0 +1,95 @@
+from datetime import date, timedelta
+
+# Supported period lengths
+GRANULARITIES = ("WEEK", "MONTH", "QUARTER")
+
+# Years covered by the precomputed calendar table; dates outside it are
+# still supported, just computed on the fly
+CALENDAR_START = 1970
+CALENDAR_END = 2100
+
+# First day of every month in the calendar table, as ISO date strings,
+# indexed by month number (see `month_index`) less the first table month
+_month_starts = [
+    f"{year:04}-{month:02}-01"
+    for year in range(CALENDAR_START, CALENDAR_END)
+    for month in range(1, 13)
+]
+_first_month = CALENDAR_START * 12
+
+
+def month_index(day):
+    """
+    Number the month containing a day, counting months from year 0, so that
+    consecutive months have consecutive numbers across year boundaries.
+    """
+    return day.year * 12 + day.month - 1
+
+
+def month_start(index):
+    """
+    Get the first day of a month, numbered as by `month_index`, as an ISO
+    date string.
+    """
+    i = index - _first_month
+    if 0 <= i < len(_month_starts):
+        return _month_starts[i]
+
+    year, month = divmod(index, 12)
+    return f"{year:04}-{month + 1:02}-01"
+
+
+def _month_period(first, count):
+    """
+    Time period of 'count' months, starting with the month numbered 'first'.
+    """
+    return {"Start": month_start(first), "End": month_start(first + count)}
+
+
+def period(today, granularity="MONTH", offset=0, fiscal_start=1, week_start=0):
+    """
+    Calculate a time period for cost explorer: the week, month or quarter
+    'offset' periods away from the one containing today, e.g. -1 for the
+    previous one.
+
+    Quarters follow the fiscal year starting in month 'fiscal_start'
+    (1 for January), and weeks start on 'week_start' (0 for Monday).
+
+    The Start date is inclusive, and the End date is exclusive
+    """
+    if granularity == "MONTH":
+        return _month_period(month_index(today) + offset, 1)
+
+    if granularity == "QUARTER":
+        # Count quarters from the start of fiscal year 0
+        quarter = (month_index(today) - (fiscal_start - 1)) // 3 + offset
+        return _month_period(quarter * 3 + fiscal_start - 1, 3)
+
+    if granularity == "WEEK":
+        day = date(today.year, today.month, today.day)
+        start = day - timedelta(days=(day.weekday() - week_start) % 7)
+        start += timedelta(weeks=offset)
+        end = start + timedelta(weeks=1)
+        return {"Start": start.isoformat(), "End": end.isoformat()}
+
+    raise ValueError(f"Unsupported granularity: {granularity}")
+
+
+def report_periods(today, granularity="MONTH", **kwargs):
+    """
+    Calculate the target and compare periods for a report run on 'today':
+    the last complete period, and the one before it.
+    """
+    target_period = period(today, granularity, -1, **kwargs)
+    compare_period = period(today, granularity, -2, **kwargs)
+    return target_period, compare_period
+
+
+def forecast_period(today, granularity="MONTH", **kwargs):
+    """
+    Calculate the time period for cost explorer forecasts: the rest of the
+    current period, starting today.
+    """
+    day = date(today.year, today.month, today.day)
+    end = period(today, granularity, **kwargs)["End"]
+    return {"Start": day.isoformat(), "End": end}
@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+from collections import namedtuple
+
+from s3_cost_report import ce
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# Types of Cost Explorer group that a section can break costs down by
+GROUP_TYPES = ("DIMENSION", "TAG", "COST_CATEGORY")
+
+
+class Section(
+    namedtuple(
+        "Section",
+        ["name", "title", "header", "group_by", "filter", "description"],
+        defaults=(None, None),
+    )
+):
+    """
+    One breakdown in the report: a table of costs grouped by a dimension,
+    tag or cost category, optionally filtered.
+
+    'name' identifies the section in report data and snapshots, 'title' is
+    the paragraph before its table, 'header' is the heading of the column
+    of group values, 'group_by' is a Cost Explorer GroupBy definition, and
+    'filter' is a Cost Explorer filter expression (or None). 'description'
+    names the totals when there are none, e.g. 'service totals'.
+    """
+
+    def value(self, key):
+        """
+        Get the group value from a key in a Cost Explorer response.
+        """
+        return ce.group_value(self.group_by, key)
+
+    def label(self, value):
+        """
+        Display name for a group value, naming the empty value of a tag or
+        cost category.
+        """
+        if value == "" and self.group_by["Type"] != "DIMENSION":
+            return f"(no {self.group_by['Key']})"
+        return value
+
+    def forecast_filter(self, value):
+        """
+        Filter for the costs of a single group value in this section.
+        """
+        return ce.and_filters(self.filter, ce.group_filter(self.group_by, value))
+
+    def empty(self):
+        """
+        Text for a section without any totals.
+        """
+        return self.description or f"{self.header} totals"
+
+
+SERVICES = Section(
+    name="services",
+    title="Break-down of total monthly costs by service:",
+    header="AWS Service",
+    group_by=ce.service_group,
+    description="service totals",
+)
+
+S3_USAGE = Section(
+    name="s3_usage",
+    title="Break-down of monthly S3 costs by usage type:",
+    header="S3 Usage Type",
+    group_by=ce.usage_type_group,
+    filter=ce.s3_service_filter,
+    description="S3 usage totals",
+)
+
+# Sections included in every report, in order
+DEFAULT_SECTIONS = (SERVICES, S3_USAGE)
+
+
+def from_config(config):
+    """
+    Create a section from a configuration dictionary with the same keys as
+    `Section`, e.g.
+    ```
+    {
+        "name": "projects",
+        "title": "Break-down of total monthly costs by project:",
+        "header": "Project",
+        "group_by": {"Type": "TAG", "Key": "Project"}
+    }
+    ```
+    Raises a ValueError if the configuration is not valid.
+    """
+    unknown = set(config) - set(Section._fields)
+    if unknown:
+        raise ValueError(f"Unknown section settings: {', '.join(sorted(unknown))}")
+
+    required = ("name", "title", "header", "group_by")
+    missing = [field for field in required if field not in config]
+    if missing:
+        raise ValueError(f"Missing section settings: {', '.join(missing)}")
+
+    group_by = config["group_by"]
+    if not isinstance(group_by, dict) or set(group_by) != {"Type", "Key"}:
+        raise ValueError(f"Section group_by needs a Type and Key: {group_by}")
+    if group_by["Type"] not in GROUP_TYPES:
+        raise ValueError(f"Unsupported section group type: {group_by['Type']}")
+
+    return Section(**config)
+
+
+def from_environment():
+    """
+    List the sections to report on: the default sections, followed by any
+    configured as a JSON list in the REPORT_SECTIONS env var (see
+    `from_config`).
+
+    Raises a ValueError if the configuration is not valid.
+    """
+    report_sections = list(DEFAULT_SECTIONS)
+
+    config = os.environ.get("REPORT_SECTIONS", "").strip()
+    if config:
+        report_sections.extend(from_config(c) for c in json.loads(config))
+
+    names = [section.name for section in report_sections]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate section names: {', '.join(duplicates)}")
+
+    LOG.info(f"Report sections: {names}")
+    return report_sections
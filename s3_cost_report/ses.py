@@ -1,10 +1,14 @@
+import html as html_lib
 import logging
 import os
+from datetime import datetime
 
 import boto3
 from botocore.config import Config as BotoConfig
 from botocore.exceptions import ClientError
 
+from s3_cost_report import amounts, memory, sections
+
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.DEBUG)
 
@@ -19,6 +23,40 @@ ses_config = BotoConfig(
 ses_client = boto3.client("ses", config=ses_config)
 
 
+class ReportBuffer:
+    """
+    Collect rendered output, optionally up to a limit on its length.
+
+    Output is kept as a list of chunks and joined once at the end, rather
+    than re-copying the whole body on every append. Once a chunk would take
+    the output over the limit, it and everything after it is dropped and
+    the notice is added instead.
+    """
+
+    def __init__(self, limit=None, notice="\n[Report truncated]\n"):
+        self.limit = limit
+        self.notice = notice
+        self.size = 0
+        self.truncated = False
+        self._chunks = []
+
+    def write(self, text):
+        if self.truncated:
+            return
+
+        if self.limit is not None and self.size + len(text) > self.limit:
+            LOG.warning(f"Report truncated at {self.size} characters")
+            self._chunks.append(self.notice)
+            self.truncated = True
+            return
+
+        self._chunks.append(text)
+        self.size += len(text)
+
+    def getvalue(self):
+        return "".join(self._chunks)
+
+
 def _table_row_style(i):
     """
     Alternating table row background colors.
@@ -29,17 +67,15 @@ def _table_row_style(i):
         return ""
 
 
-def build_paragraph(text, html=False):
+def write_paragraph(output, text, html=False):
     """
-    Format a text block as a paragraph.
+    Write a text block to the output as a paragraph.
     """
-    output = ""
-
     if html:
         # Put the paragraph in an invisible table to wrap long lines;
         # give the table a single row with two cells, put the text in
         # the first cell and let the second cell fill any extra space
-        output += (
+        output.write(
             "<table border='0' width='100%' "
             "style='border-collapse: collapse;'><tr>"
             f"<td width='600'>{text}</td><td></td>"
@@ -47,182 +83,323 @@ def build_paragraph(text, html=False):
         )
     else:
         # Just add a newline
-        output += text + "\n"
+        output.write(text + "\n")
+
 
-    return output
+def build_paragraph(text, html=False):
+    """
+    Format a text block as a paragraph.
+    """
+    output = ReportBuffer()
+    write_paragraph(output, text, html)
+    return output.getvalue()
 
 
-def build_service_table(services, html=False):
+def _has_forecast(data):
     """
-    Build a table from a dictionary of service totals.
+    Whether any row in a table's data has a forecast.
+    """
+    return any("forecast" in row for row in data.values())
+
+
+def write_cost_table(output, costs, name_header, html=False, label=str):
+    """
+    Write a table of a dictionary of cost totals (see `amounts`) to the
+    output, with the keys in a column under 'name_header'. 'label' gives
+    the display name of each key.
+
+    Rows are written in the order of the dictionary, so the HTML and text
+    tables share the order the report data was sorted in (see
+    `app.join_totals`). A forecast column is added if any key has a forecast.
 
     Example input block:
     ```
     ec2:
-        total: 10.0
+        total: 100000000000
     s3:
-        total: 20.0
+        total: 200000000000
         change: 0.5
+        forecast: 250000000000
     ```
     """
 
-    output = ""
+    headers = [name_header, "Total", "Month-over-Month Change"]
+
+    forecast = _has_forecast(costs)
+    if forecast:
+        headers.append("Current Month Forecast")
 
     # Table header
     if html:
-        output += (
+        output.write(
             "<table border='1' padding='10' width='600' "
             "style='border-collapse: collapse; text-align: center;'>"
             "<tr style='background-color: LightSteelBlue'>"
-            "<th>AWS Service</th>"
-            f"<th>Total</th><th>Month-over-Month Change</th></tr>"
+            + "".join(f"<th>{header}</th>" for header in headers)
+            + "</tr>"
         )
         row_i = 0  # row index for coloring table rows
     else:
-        output += (
-            "\t".join(["AWS Service", "Total", "Month-over-Month Change"])
-            + "\n"
-        )
+        output.write("\t".join(headers) + "\n")
 
     # Table rows
-    for service in services:
+    for key in costs:
         # Round dollar total to 2 decimal places
-        total = f"${services[service]['total']:.2f}"
+        total = amounts.format_dollars(costs[key]["total"])
 
         change = ""
-        if "change" in services[service]:
+        if "change" in costs[key]:
             # Convert to a percentage
-            change = f"{services[service]['change']:.2%}"
+            change = f"{costs[key]['change']:.2%}"
+
+        _cells = [label(key), total, change]
+        if forecast:
+            _forecast = ""
+            if "forecast" in costs[key]:
+                _forecast = amounts.format_dollars(costs[key]["forecast"])
+            _cells.append(_forecast)
 
         if html:
-            _td = f"<td>{service}</td>" f"<td>{total}</td><td>{change}</td>"
+            # Group values such as tag values are user-supplied, so escape
+            # every cell
+            _td = "".join(f"<td>{html_lib.escape(cell)}</td>" for cell in _cells)
 
             _style = _table_row_style(row_i)
-            output += f"<tr {_style}>{_td}</tr>"
+            output.write(f"<tr {_style}>{_td}</tr>")
             row_i += 1
 
         else:
-            _td = [service, total, change]
-            output += "\t".join(_td) + "\n"
+            output.write("\t".join(_cells) + "\n")
 
     # Table end
     if html:
-        output += "</table><br/>"
+        output.write("</table><br/>")
+
+
+def write_service_table(output, services, html=False):
+    """
+    Write a table of a dictionary of service totals to the output.
+    """
+    write_cost_table(output, services, sections.SERVICES.header, html)
+
+
+def build_service_table(services, html=False):
+    """
+    Build a table from a dictionary of service totals.
+    """
+    output = ReportBuffer()
+    write_service_table(output, services, html)
+    return output.getvalue()
 
-    return output
+
+def write_usage_table(output, usages, html=False):
+    """
+    Write a table of a dictionary of S3 usage costs to the output.
+    """
+    write_cost_table(output, usages, sections.S3_USAGE.header, html)
 
 
 def build_usage_table(usages, html=False):
     """
-    Build a table from a dictionary of S3 usage costs
+    Build a table from a dictionary of S3 usage costs.
+    """
+    output = ReportBuffer()
+    write_usage_table(output, usages, html)
+    return output.getvalue()
+
+
+def write_changes_table(output, changes, name_header, html=False, label=str):
+    """
+    Write a table of a dictionary of totals that changed since the last
+    report (see `snapshots.diff_sections`) to the output. 'label' gives the
+    display name of each key.
 
     Example input block:
     ```
-    s3-bytes-out:
-        total: 10.0
-    s3-timed-storage:
-        total: 20.0
-        change: 0.5
+    ec2:
+        total: 100000000000
+        previous: 50000000000
+        change: 1.0
     ```
     """
 
-    output = ""
-    total = "Total"
+    headers = [name_header, "Last Report", "This Report", "Change"]
 
     # Table header
     if html:
-        output += (
+        output.write(
             "<table border='1' padding='10' width='600' "
             "style='border-collapse: collapse; text-align: center;'>"
             "<tr style='background-color: LightSteelBlue'>"
-            "<th>S3 Usage Type</th>"
-            f"<th>Total</th><th>Month-over-Month Change</th></tr>"
+            + "".join(f"<th>{header}</th>" for header in headers)
+            + "</tr>"
         )
         row_i = 0  # row index for coloring table rows
     else:
-        output += (
-            "\t".join(["S3 Usage Type", "Total", "Month-over-Month Change"])
-            + "\n"
-        )
+        output.write("\t".join(headers) + "\n")
 
     # Table rows
-    for usage_type in usages:
-        # Round dollar total to 2 decimal places
-        total = f"${usages[usage_type]['total']:.2f}"
+    for key in changes:
+        # Round dollar totals to 2 decimal places
+        previous = amounts.format_dollars(changes[key]["previous"])
+        total = amounts.format_dollars(changes[key]["total"])
 
-        change = ""
-        if "change" in usages[usage_type]:
-            # Convert to a percentage
-            change = f"{usages[usage_type]['change']:.2%}"
+        # Convert to a percentage
+        change = f"{changes[key]['change']:.2%}"
 
         if html:
             _td = (
-                f"<td>{usage_type}</td>"
+                f"<td>{html_lib.escape(label(key))}</td><td>{previous}</td>"
                 f"<td>{total}</td><td>{change}</td>"
             )
 
             _style = _table_row_style(row_i)
-            output += f"<tr {_style}>{_td}</tr>"
+            output.write(f"<tr {_style}>{_td}</tr>")
             row_i += 1
 
         else:
-            _td = [usage_type, total, change]
-            output += "\t".join(_td) + "\n"
+            _td = [label(key), previous, total, change]
+            output.write("\t".join(_td) + "\n")
 
     # Table end
     if html:
-        output += "</table><br/>"
-
-    return output
+        output.write("</table><br/>")
 
 
-def build_email_body(account, service_data, s3_usage_data):
+def build_changes_table(changes, name_header, html=False):
     """
-    Compose the email bodies (both a plain-text and HTML version), with
-    a table for service costs, and a table for S3 usage type costs.
+    Build a table from a dictionary of totals that changed since the last
+    report.
+    """
+    output = ReportBuffer()
+    write_changes_table(output, changes, name_header, html)
+    return output.getvalue()
+
+
+def build_report_body(
+    account,
+    report_sections,
+    data,
+    last_period=None,
+    last_changes=None,
+    stale_period=None,
+    stale=None,
+):
     """
+    Compose the email bodies (both a plain-text and HTML version), with a
+    table of costs for each report section (see `sections`). 'data' maps
+    each section name to its costs.
+
+    Sections missing from the data could not be fetched. If 'stale' maps
+    any of them to their last known totals, from the snapshot of the
+    report for 'stale_period', those totals are shown instead, marked as
+    out of date; otherwise the section is marked as unavailable.
 
-    # Ignore totals under this amount
-    minimum = float(os.environ["MINIMUM"])
+    If the changes since an earlier report for the same period, from the
+    snapshot for 'last_period', are given, add a section with a table of
+    restated totals for each report section.
+
+    In low-memory mode the bodies are capped in length (see `memory`).
+    """
 
-    service_prose = "\nBreak-down of total monthly costs by service:"
-    s3_usage_prose = "\nBreak-down of monthly S3 costs by usage type:"
     no_data_prose = "\nNo data found for"
+    unavailable_prose = "\nCost Explorer data is unavailable for"
+
+    limit = memory.body_limit()
+    html_body = ReportBuffer(limit, "</table><p>[Report truncated]</p>")
+    text_body = ReportBuffer(limit)
+
+    # Write each block to both bodies
+    def _write(write_block, *args, **kwargs):
+        write_block(html_body, *args, html=True, **kwargs)
+        write_block(text_body, *args, html=False, **kwargs)
 
     title = f"AWS Monthly Cost Summary for Account {account}"
-    html_body = f"<h3>{title}</h3>"
-    text_body = f"{title}\n"
+    html_body.write(f"<h3>{title}</h3>")
+    text_body.write(f"{title}\n")
 
-    if service_data:
-        html_body += build_paragraph(service_prose, True)
-        text_body += build_paragraph(service_prose, False)
+    stale = stale or {}
 
-        html_body += build_service_table(service_data, True)
-        text_body += build_service_table(service_data, False)
-    else:
-        no_service_data = f"{no_data_prose} service totals\n"
-        html_body += build_paragraph(no_service_data, True)
-        text_body += build_paragraph(service_prose, False)
+    for section in report_sections:
+        if section.name in stale and section.name not in data:
+            _dt = datetime.fromisoformat(stale_period["Start"])
+            stale_prose = (
+                "Cost Explorer data is unavailable, showing the last known "
+                f"totals from the {_dt.strftime('%B %Y')} report:"  # Month Year
+            )
+            totals = stale[section.name]
+            costs = {key: {"total": totals[key]} for key in totals}
+
+            _write(write_paragraph, f"\n{section.title}")
+            _write(write_paragraph, stale_prose)
+            _write(write_cost_table, costs, section.header, label=section.label)
+
+        elif section.name not in data:
+            _write(write_paragraph, f"{unavailable_prose} {section.empty()}\n")
+
+        elif data[section.name]:
+            _write(write_paragraph, f"\n{section.title}")
+            _write(
+                write_cost_table,
+                data[section.name],
+                section.header,
+                label=section.label,
+            )
 
-    if s3_usage_data:
-        html_body += build_paragraph(s3_usage_prose, True)
-        text_body += build_paragraph(s3_usage_prose, False)
+        else:
+            _write(write_paragraph, f"{no_data_prose} {section.empty()}\n")
 
-        html_body += build_usage_table(s3_usage_data, True)
-        text_body += build_usage_table(s3_usage_data, False)
-    else:
-        no_s3_usage_data = f"{no_data_prose} S3 usage totals\n"
-        html_body += build_paragraph(no_s3_usage_data, True)
-        text_body += build_paragraph(service_prose, False)
+    if last_changes is not None:
+        _dt = datetime.fromisoformat(last_period["Start"])
+        last_prose = (
+            "\nChanges since the last report for "
+            f"{_dt.strftime('%B %Y')}:"  # Month Year
+        )
+        _write(write_paragraph, last_prose)
+
+        if any(last_changes.values()):
+            for section in report_sections:
+                changes = last_changes.get(section.name)
+                if changes:
+                    _write(
+                        write_changes_table,
+                        changes,
+                        section.header,
+                        label=section.label,
+                    )
+        else:
+            _write(write_paragraph, "No totals have changed\n")
+
+    html_body = html_body.getvalue()
+    text_body = text_body.getvalue()
 
-    LOG.debug(html_body)
-    LOG.debug(text_body)
+    LOG.debug(memory.log_preview(html_body))
+    LOG.debug(memory.log_preview(text_body))
     return html_body, text_body
 
 
-def send_email(subject, body_html, body_text):
+def build_email_body(
+    account, service_data, s3_usage_data, last_period=None, last_changes=None
+):
     """
-    Send an e-mail through SES with both a text body and an HTML body.
+    Compose the email bodies (both a plain-text and HTML version), with
+    a table for service costs, and a table for S3 usage type costs.
+
+    See `build_report_body` for reports with other sections.
+    """
+    data = {
+        sections.SERVICES.name: service_data,
+        sections.S3_USAGE.name: s3_usage_data,
+    }
+    return build_report_body(
+        account, sections.DEFAULT_SECTIONS, data, last_period, last_changes
+    )
+
+
+def deliver_email(subject, body_html, body_text):
+    """
+    Send an e-mail through SES with both a text body and an HTML body,
+    raising any errors from SES.
     """
 
     # Sender and Recipients are configured from env vars.
@@ -232,33 +409,42 @@ def send_email(subject, body_html, body_text):
     # Python3 uses UTF-8
     charset = "UTF-8"
 
-    # Send the email.
-    try:
-        response = ses_client.send_email(
-            Destination={
-                "ToAddresses": recipients,
-            },
-            Message={
-                "Body": {
-                    "Html": {
-                        "Charset": charset,
-                        "Data": body_html,
-                    },
-                    "Text": {
-                        "Charset": charset,
-                        "Data": body_text,
-                    },
+    response = ses_client.send_email(
+        Destination={
+            "ToAddresses": recipients,
+        },
+        Message={
+            "Body": {
+                "Html": {
+                    "Charset": charset,
+                    "Data": body_html,
                 },
-                "Subject": {
+                "Text": {
                     "Charset": charset,
-                    "Data": subject,
+                    "Data": body_text,
                 },
             },
-            Source=sender,
-        )
+            "Subject": {
+                "Charset": charset,
+                "Data": subject,
+            },
+        },
+        Source=sender,
+    )
+
+    LOG.info(f"Email sent! Message ID: {response['MessageId']}")
+    return response
+
+
+def send_email(subject, body_html, body_text):
+    """
+    Send an e-mail through SES with both a text body and an HTML body.
+    """
+
+    # Send the email.
+    try:
+        deliver_email(subject, body_html, body_text)
 
     # Display an error if something goes wrong.
     except ClientError as e:
         LOG.exception(e)
-    else:
-        LOG.info(f"Email sent! Message ID: {response['MessageId']}")
@@ -0,0 +1,243 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.request
+from collections import namedtuple
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from s3_cost_report import ses, snapshots
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+# A rendered report. The name identifies the report for sinks that store
+# it, e.g. the start of its target period.
+Report = namedtuple("Report", ["name", "subject", "html", "text"])
+
+
+class Sink:
+    """
+    Base class for report outputs.
+
+    Each sink delivers reports from its own bounded queue on its own worker
+    thread, retrying failed deliveries with exponential back-off until it
+    runs out of retries or its timeout. Subclasses implement `send`.
+    """
+
+    name = "sink"
+
+    def __init__(self, timeout=30, retries=2, backoff=1.0, queue_size=1):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._worker = None
+
+    def send(self, report, timeout):
+        """
+        Deliver a report once, raising an exception on failure.
+        """
+        raise NotImplementedError
+
+    def deliver(self, report, deadline):
+        """
+        Deliver a report, retrying until it succeeds or the deadline passes.
+        """
+        attempt = 0
+        while True:
+            try:
+                self.send(report, max(deadline - time.monotonic(), 0))
+                return
+            except Exception as e:
+                delay = self.backoff * 2**attempt
+                attempt += 1
+                if attempt > self.retries or time.monotonic() + delay >= deadline:
+                    raise
+                LOG.warning(f"Retrying {self.name} after error: {e}")
+                time.sleep(delay)
+
+    def _run(self):
+        while True:
+            report, deadline, future = self.queue.get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    self.deliver(report, deadline)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(True)
+            self.queue.task_done()
+
+    def submit(self, report, deadline):
+        """
+        Queue a report for delivery by the deadline, returning a future for
+        the result. Fails straight away if the queue is full, so a backed-up
+        sink cannot hold up submitting to the others.
+        """
+        if self._worker is None:
+            self._worker = threading.Thread(
+                target=self._run, name=f"sink-{self.name}", daemon=True
+            )
+            self._worker.start()
+
+        future = Future()
+        try:
+            self.queue.put_nowait((report, deadline, future))
+        except queue.Full:
+            future.set_exception(RuntimeError(f"{self.name} queue is full"))
+        return future
+
+
+class SesSink(Sink):
+    """
+    Send the report as an email through SES.
+
+    The SES client already retries throttled requests, so by default this
+    sink does not retry on top of that.
+    """
+
+    name = "ses"
+
+    def __init__(self, timeout=60, retries=0, **kwargs):
+        super().__init__(timeout=timeout, retries=retries, **kwargs)
+
+    def send(self, report, timeout):
+        ses.deliver_email(report.subject, report.html, report.text)
+
+
+class WebhookSink(Sink):
+    """
+    Post the plain-text report to a Slack or Teams compatible webhook.
+    """
+
+    name = "webhook"
+
+    def __init__(self, url, timeout=10, **kwargs):
+        super().__init__(timeout=timeout, **kwargs)
+        self.url = url
+
+    @staticmethod
+    def payload(report):
+        # Both Slack and Teams incoming webhooks accept a 'text' field with
+        # markdown; use a code block to keep the tables aligned
+        return {"text": f"*{report.subject}*\n```\n{report.text}```"}
+
+    def send(self, report, timeout):
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(self.payload(report)).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            LOG.info(f"Webhook response: {response.status}")
+
+
+class StoreSink(Sink):
+    """
+    Write the HTML and plain-text report to a file or object store (see
+    `snapshots.FileStore` and `snapshots.S3Store`).
+    """
+
+    name = "store"
+
+    def __init__(self, backend, timeout=30, **kwargs):
+        super().__init__(timeout=timeout, **kwargs)
+        self.backend = backend
+
+    def send(self, report, timeout):
+        self.backend.put(f"{report.name}.html", report.html.encode("utf-8"))
+        self.backend.put(f"{report.name}.txt", report.text.encode("utf-8"))
+        LOG.info(f"Stored report {report.name}")
+
+
+# Sinks created from the environment, kept for the life of the container so
+# that each sink's worker thread and bounded queue are reused across
+# invocations rather than started again on every run
+_sinks = {}
+
+
+def _shared(key, create):
+    if key not in _sinks:
+        _sinks[key] = create()
+    return _sinks[key]
+
+
+def from_environment():
+    """
+    Get the configured sinks: SES if RECIPIENTS is set, a webhook if
+    WEBHOOK_URL is set, and a store if REPORT_BUCKET (with an optional
+    REPORT_PREFIX) or REPORT_DIR is set.
+
+    The same configuration always gets the same sink objects.
+    """
+    sinks = []
+
+    if os.environ.get("RECIPIENTS"):
+        sinks.append(_shared(("ses",), SesSink))
+
+    url = os.environ.get("WEBHOOK_URL")
+    if url:
+        sinks.append(_shared(("webhook", url), lambda: WebhookSink(url)))
+
+    bucket = os.environ.get("REPORT_BUCKET")
+    directory = os.environ.get("REPORT_DIR")
+    if bucket:
+        prefix = os.environ.get("REPORT_PREFIX", "reports/")
+        sinks.append(
+            _shared(
+                ("store", "s3", bucket, prefix),
+                lambda: StoreSink(snapshots.S3Store(bucket, prefix)),
+            )
+        )
+    elif directory:
+        sinks.append(
+            _shared(
+                ("store", "dir", directory),
+                lambda: StoreSink(snapshots.FileStore(directory)),
+            )
+        )
+
+    return sinks
+
+
+def dispatch(sinks, report, deadline=None):
+    """
+    Deliver a report to all sinks concurrently.
+
+    Each sink gets its own deadline, so waiting on a slow or failing sink
+    never holds up the others beyond that sink's timeout. If an overall
+    deadline (a time.monotonic() value) is given, no sink waits past it.
+    Returns a dictionary mapping each sink name to True if it delivered the
+    report, or to the exception that stopped it.
+    """
+    start = time.monotonic()
+
+    futures = []
+    for sink in sinks:
+        sink_deadline = start + sink.timeout
+        if deadline is not None:
+            sink_deadline = min(sink_deadline, deadline)
+        futures.append((sink, sink_deadline, sink.submit(report, sink_deadline)))
+
+    results = {}
+    for sink, sink_deadline, future in futures:
+        remaining = max(sink_deadline - time.monotonic(), 0)
+        try:
+            results[sink.name] = future.result(timeout=remaining)
+        except FutureTimeoutError:
+            future.cancel()
+            results[sink.name] = TimeoutError(f"{sink.name} timed out")
+        except Exception as e:
+            results[sink.name] = e
+
+        if results[sink.name] is True:
+            LOG.info(f"Delivered report to {sink.name}")
+        else:
+            LOG.error(f"Failed to deliver report to {sink.name}: {results[sink.name]}")
+
+    return results
@@ -0,0 +1,218 @@
+import gzip
+import json
+import logging
+import os
+from pathlib import Path
+
+import boto3
+from botocore.exceptions import ClientError
+
+from s3_cost_report import index
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.DEBUG)
+
+s3_client = boto3.client("s3")
+
+# Bump this if the snapshot layout changes in an incompatible way
+SNAPSHOT_VERSION = 1
+
+SNAPSHOT_SUFFIX = ".json.gz"
+
+
+class FileStore:
+    """
+    Store snapshot objects as files in a local directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def put(self, name, data):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        (self.directory / name).write_bytes(data)
+
+    def get(self, name):
+        try:
+            return (self.directory / name).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def list(self):
+        if not self.directory.is_dir():
+            return []
+        return sorted(p.name for p in self.directory.iterdir() if p.is_file())
+
+
+class MemoryStore:
+    """
+    Local stand-in for an object store, keeping objects in a dictionary.
+    """
+
+    def __init__(self):
+        self.objects = {}
+
+    def put(self, name, data):
+        self.objects[name] = bytes(data)
+
+    def get(self, name):
+        return self.objects.get(name)
+
+    def list(self):
+        return sorted(self.objects)
+
+
+class S3Store:
+    """
+    Store snapshot objects in an S3 bucket under a key prefix.
+    """
+
+    def __init__(self, bucket, prefix="", client=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = client or s3_client
+
+    def put(self, name, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + name, Body=data)
+
+    def get(self, name):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + name)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        return response["Body"].read()
+
+    def list(self):
+        names = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                names.append(obj["Key"][len(self.prefix) :])
+        return sorted(names)
+
+
+def encode_snapshot(period, sections):
+    """
+    Serialize a snapshot of the parsed report data.
+
+    'sections' maps a section name (e.g. 'services') to a dictionary of
+    totals keyed by service or usage type. Each section is stored as two
+    parallel columns, keys and totals, and the whole document is gzipped.
+    """
+    document = {
+        "version": SNAPSHOT_VERSION,
+        "period": period,
+        "sections": {
+            name: {"keys": list(totals), "totals": list(totals.values())}
+            for name, totals in sections.items()
+        },
+    }
+    encoded = json.dumps(document, separators=(",", ":")).encode("utf-8")
+    return gzip.compress(encoded)
+
+
+def decode_snapshot(data):
+    """
+    Deserialize a snapshot, returning the period and the sections as
+    dictionaries of totals.
+    """
+    document = json.loads(gzip.decompress(data))
+
+    if document.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version: {document.get('version')}")
+
+    sections = {
+        name: dict(zip(columns["keys"], columns["totals"]))
+        for name, columns in document["sections"].items()
+    }
+    return document["period"], sections
+
+
+class SnapshotStore:
+    """
+    Keep a snapshot of each report, named by the start of its target period
+    so that names sort chronologically.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def _name(period):
+        return f"{period['Start']}{SNAPSHOT_SUFFIX}"
+
+    def save(self, period, sections):
+        name = self._name(period)
+        self.backend.put(name, encode_snapshot(period, sections))
+        LOG.info(f"Saved report snapshot {name}")
+
+    def load(self, period):
+        data = self.backend.get(self._name(period))
+        if data is None:
+            return None
+        return decode_snapshot(data)
+
+    def latest(self, before):
+        """
+        Load the most recent snapshot for a period starting before the
+        given period, or None if there is no earlier snapshot.
+        """
+        cutoff = self._name(before)
+        names = [
+            name
+            for name in self.backend.list()
+            if name.endswith(SNAPSHOT_SUFFIX) and name < cutoff
+        ]
+        if not names:
+            return None
+
+        LOG.info(f"Comparing against report snapshot {names[-1]}")
+        return decode_snapshot(self.backend.get(names[-1]))
+
+
+def from_environment():
+    """
+    Create a snapshot store from the environment: SNAPSHOT_BUCKET (with an
+    optional SNAPSHOT_PREFIX) for S3, or SNAPSHOT_DIR for a local directory.
+    Returns None if snapshots are not configured.
+    """
+    bucket = os.environ.get("SNAPSHOT_BUCKET")
+    if bucket:
+        prefix = os.environ.get("SNAPSHOT_PREFIX", "snapshots/")
+        return SnapshotStore(S3Store(bucket, prefix))
+
+    directory = os.environ.get("SNAPSHOT_DIR")
+    if directory:
+        return SnapshotStore(FileStore(directory))
+
+    return None
+
+
+def diff_sections(current, previous):
+    """
+    Compare the sections of a new snapshot against a previous one.
+
+    Returns a dictionary keyed by section name, each mapping the keys whose
+    totals differ to their 'total', 'previous' and 'change'. Keys that were
+    added or removed since the previous snapshot are included, with a zero
+    total on the missing side, and the keys are sorted by the change in
+    their totals, largest increase first. Sections that are unchanged are
+    empty.
+    """
+    changes = {}
+
+    for name, totals in current.items():
+        joined = index.CostIndex(totals, previous.get(name, {}))
+
+        changes[name] = {}
+        for row in joined.rows("delta", reverse=True):
+            if row.delta != 0:
+                changes[name][row.key] = {
+                    "total": row.totals[0],
+                    "previous": row.totals[1],
+                    "change": row.change,
+                }
+
+    return changes
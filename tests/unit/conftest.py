@@ -5,7 +5,14 @@ import pytest
 # This needs to be set when the modules are loaded,
 # but its value is not used when running tests
 os.environ["AWS_DEFAULT_REGION"] = "test-region"
-from s3_cost_report import ce
+from s3_cost_report import amounts, ce, fetch
+
+# Timing comparisons are too noisy to run on shared CI runners, so they only
+# run when asked for with BENCHMARK=true
+benchmark = pytest.mark.skipif(
+    os.environ.get("BENCHMARK", "false").lower() != "true",
+    reason="set BENCHMARK=true to run benchmarks",
+)
 
 # Constants used by fixtures
 
@@ -13,8 +20,10 @@ ce_period = {"Start": "2023-01-01", "End": "2023-02-01"}
 
 # Set up the test scenario used by all tests
 #
-# There are three mock service totals: one is typical, the second is lacking
-# comparison data, and the third is less than the minimum value to report.
+# There are five mock service totals: one is typical, the second is lacking
+# comparison data, the third is less than the minimum value to report, the
+# fourth only has comparison data (a service that is no longer used), and the
+# fifth has dropped below the minimum since the comparison period.
 # There are also three mock S3 usage types: the first tests with a zero for the
 # previous month, the second tests with a zero for the current month, and the
 # third tests with both zeros (simulating fractions of a cent rounded down).
@@ -32,6 +41,15 @@ service3_name = "lambda"
 service3_total = 0.001
 service3_change = 0.0
 
+service4_name = "rds"
+service4_total = 0.0
+service4_previous = 5.0
+service4_change = -1.0
+
+service5_name = "sns"
+service5_total = 0.005
+service5_previous = 2.0
+
 s3_usage_type1_name = "type1"
 s3_usage_type1_total = 25.0
 s3_usage_type1_previous = 0.0
@@ -52,20 +70,37 @@ s3_usage_type4_total = 1.0
 s3_usage_type4_change = 1.0
 
 
+@pytest.fixture(autouse=True)
+def reset_ce_breaker():
+    """Don't let failed queries in one test open the circuit for the next"""
+    fetch.ce_breaker.reset()
+    yield
+    fetch.ce_breaker.reset()
+
+
 # App fixtures
 
 
+def exact(amount):
+    """Convert a fixture amount to micro-cents the same way the app does"""
+    return amounts.parse_amount(str(amount))
+
+
 @pytest.fixture()
 def mock_app_service_dict():
     response = {
         service1_name: {
-            "total": service1_total,
+            "total": exact(service1_total),
             "change": service1_change,
         },
         service2_name: {
-            "total": service2_total,
+            "total": exact(service2_total),
             "change": service2_change,
         },
+        service4_name: {
+            "total": exact(service4_total),
+            "change": service4_change,
+        },
     }
     return response
 
@@ -74,19 +109,19 @@ def mock_app_service_dict():
 def mock_app_s3_usage_dict():
     response = {
         s3_usage_type1_name: {
-            "total": s3_usage_type1_total,
+            "total": exact(s3_usage_type1_total),
             "change": s3_usage_type1_change,
         },
         s3_usage_type2_name: {
-            "total": s3_usage_type2_total,
+            "total": exact(s3_usage_type2_total),
             "change": s3_usage_type2_change,
         },
         s3_usage_type3_name: {
-            "total": s3_usage_type3_total,
+            "total": exact(s3_usage_type3_total),
             "change": s3_usage_type3_change,
         },
         s3_usage_type4_name: {
-            "total": s3_usage_type4_total,
+            "total": exact(s3_usage_type4_total),
             "change": s3_usage_type4_change
         },
     }
@@ -119,12 +154,25 @@ def mock_ce_response(data):
     return response
 
 
+def mock_ce_costs(responses):
+    """
+    Stand-in for `ce.get_ce_costs`, returning the response for the group key
+    and the start of the period from a dictionary keyed by both
+    """
+
+    def _get_ce_costs(period, group_by, cost_filter=None, account_id=None):
+        return responses[(group_by["Key"], period["Start"])]
+
+    return _get_ce_costs
+
+
 @pytest.fixture()
 def mock_ce_service_target_data():
     target_totals = {
         service1_name: service1_total,
         service2_name: service2_total,
         service3_name: service3_total,
+        service5_name: service5_total,
     }
     return mock_ce_response(target_totals)
 
@@ -133,6 +181,8 @@ def mock_ce_service_target_data():
 def mock_ce_service_compare_data():
     compare_totals = {
         service1_name: service1_previous,
+        service4_name: service4_previous,
+        service5_name: service5_previous,
     }
     return mock_ce_response(compare_totals)
 
@@ -163,6 +213,32 @@ def mock_ce_period():
     return ce_period
 
 
+@pytest.fixture()
+def mock_ce_compare_period():
+    return {"Start": "2022-12-01", "End": "2023-01-01"}
+
+
+@pytest.fixture()
+def mock_ce_costs_all(
+    mock_ce_period,
+    mock_ce_compare_period,
+    mock_ce_service_target_data,
+    mock_ce_service_compare_data,
+    mock_ce_s3_usage_target_data,
+    mock_ce_s3_usage_compare_data,
+):
+    target = mock_ce_period["Start"]
+    compare = mock_ce_compare_period["Start"]
+    return mock_ce_costs(
+        {
+            ("SERVICE", target): mock_ce_service_target_data,
+            ("SERVICE", compare): mock_ce_service_compare_data,
+            ("USAGE_TYPE", target): mock_ce_s3_usage_target_data,
+            ("USAGE_TYPE", compare): mock_ce_s3_usage_compare_data,
+        }
+    )
+
+
 # SES fixtures
 
 
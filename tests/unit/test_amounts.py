@@ -0,0 +1,203 @@
+import os
+import timeit
+
+import pytest
+
+from s3_cost_report import amounts, app, ce
+
+from .conftest import benchmark, mock_ce_costs, mock_ce_response
+
+
+@pytest.mark.parametrize(
+    "amount,expected",
+    [
+        ("12.3", 123000000000),
+        ("0", 0),
+        ("42", 420000000000),
+        ("-1.5", -15000000000),
+        ("0.0000000171", 171),
+        ("-0.0000000171", -171),
+        ("0.00000000015", 2),  # past ten places, half-to-even rounds up
+        ("0.00000000025", 2),  # and down
+        ("1.5E-7", 1500),
+        ("1e2", 1000000000000),
+    ],
+)
+def test_parse_amount(amount, expected):
+    assert amounts.parse_amount(amount) == expected
+
+
+@pytest.mark.parametrize(
+    "amount,expected",
+    [
+        (123000000000, "$12.30"),
+        (123450000000, "$12.35"),  # half-up, like the CE console
+        (123449999999, "$12.34"),
+        (0, "$0.00"),
+        (10000000, "$0.00"),
+        (-15000000000, "$-1.50"),
+        (-10000000, "$0.00"),
+    ],
+)
+def test_format_dollars(amount, expected):
+    assert amounts.format_dollars(amount) == expected
+
+
+def test_parse_totals():
+    response = mock_ce_response({"a": "1.25", "b": "0.001"})
+    results = response["ResultsByTime"] * 2  # same keys in two periods
+
+    found = amounts.parse_totals(results, ce.cost_metric)
+    assert found == {"a": 25000000000, "b": 20000000}
+
+    minimum = amounts.parse_amount("0.01")
+    found = amounts.parse_totals(results, ce.cost_metric, minimum)
+    assert found == {"a": 25000000000}
+
+
+@pytest.mark.parametrize(
+    "total,compare,expected",
+    [
+        (30, 20, 0.5),
+        (0, 10, -1.0),
+        (25, 0, 1.0),
+        (0, 0, 0.0),
+    ],
+)
+def test_percent_change(total, compare, expected):
+    assert amounts.percent_change(total, compare) == expected
+
+
+def test_percent_changes():
+    totals = {"up": 30, "down": 0, "new": 5, "zero": 0, "from-zero": 25}
+    compare = {"up": 20, "down": 10, "zero": 0, "from-zero": 0, "gone": 5}
+
+    found = amounts.percent_changes(totals, compare)
+    assert found == {
+        "up": 0.5,
+        "down": -1.0,
+        "new": 1.0,
+        "zero": 0.0,
+        "from-zero": 1.0,
+    }
+
+
+def test_exact_sum():
+    # a thousand ten-cent charges are exactly $100, which floats miss
+    rows = ["0.1"] * 1000
+    assert sum(float(r) for r in rows) != 100.0
+
+    total = sum(amounts.parse_amount(r) for r in rows)
+    assert total == 100 * amounts.SCALE
+    assert amounts.format_dollars(total) == "$100.00"
+
+
+# Benchmarks against the previous float-based dict walk. These only run with
+# BENCHMARK=true, and record their timings as test properties.
+#
+# Neither is as fast as the float walk at 100k rows. Aggregating the flat
+# scaled totals takes up to about a third longer, and end to end (parsing the
+# amount strings exactly, joining the periods and sorting the rows) takes about
+# three times as long. The assertions only guard against regressions beyond
+# that.
+
+BENCHMARK_ROWS = 100_000
+
+
+def _float_totals(results_by_time):
+    """Parse amounts into nested dicts of floats, as the app used to"""
+    data = {}
+    for result in results_by_time:
+        for group in result["Groups"]:
+            data[group["Keys"][0]] = {
+                "total": float(group["Metrics"][ce.cost_metric]["Amount"])
+            }
+    return data
+
+
+def _float_aggregate(target, compare):
+    """Walk the nested float dicts to total them and calculate changes"""
+    total = 0.0
+    for key, row in target.items():
+        total += row["total"]
+        if key in compare:
+            _compare = compare[key]["total"]
+            if _compare == 0:
+                row["change"] = 0 if row["total"] == 0 else 1
+            else:
+                row["change"] = (row["total"] / _compare) - 1
+        else:
+            row["change"] = 1.0
+    return total
+
+
+def _exact_aggregate(target, compare):
+    """Total the flat scaled amounts and calculate changes"""
+    changes = amounts.percent_changes(target, compare)
+    return sum(target.values()), changes
+
+
+@pytest.fixture(scope="module")
+def benchmark_results():
+    # amounts with ten decimal places, like Cost Explorer returns
+    target = {f"k{i}": f"{i * 1.37:.10f}" for i in range(BENCHMARK_ROWS)}
+    compare = {f"k{i}": f"{i * 1.11:.10f}" for i in range(BENCHMARK_ROWS)}
+    return (
+        mock_ce_response(target)["ResultsByTime"],
+        mock_ce_response(compare)["ResultsByTime"],
+    )
+
+
+def _best_time(func):
+    # best of several runs to reduce scheduler noise
+    return min(timeit.repeat(func, number=1, repeat=7))
+
+
+@benchmark
+def test_benchmark_aggregate(record_property, benchmark_results):
+    target_results, compare_results = benchmark_results
+
+    float_target = _float_totals(target_results)
+    float_compare = _float_totals(compare_results)
+    exact_target = amounts.parse_totals(target_results, ce.cost_metric)
+    exact_compare = amounts.parse_totals(compare_results, ce.cost_metric)
+
+    float_time = _best_time(lambda: _float_aggregate(float_target, float_compare))
+    exact_time = _best_time(lambda: _exact_aggregate(exact_target, exact_compare))
+    record_property("float_time", float_time)
+    record_property("exact_time", exact_time)
+
+    # the exact total matches summing the decimal strings directly
+    expected = sum(
+        amounts._parse_decimal(g["Metrics"][ce.cost_metric]["Amount"])
+        for g in target_results[0]["Groups"]
+    )
+    found, _ = _exact_aggregate(exact_target, exact_compare)
+    assert found == expected
+
+    assert exact_time <= float_time * 1.5
+
+
+@benchmark
+def test_benchmark_parse(mocker, record_property, benchmark_results):
+    mocker.patch.dict(os.environ, {"MINIMUM": "0"})
+    target_results, compare_results = benchmark_results
+
+    def run_float():
+        _float_aggregate(_float_totals(target_results), _float_totals(compare_results))
+
+    responses = {
+        ("SERVICE", "target"): {"ResultsByTime": target_results},
+        ("SERVICE", "compare"): {"ResultsByTime": compare_results},
+    }
+    mocker.patch("s3_cost_report.ce.get_ce_costs", side_effect=mock_ce_costs(responses))
+
+    def run_exact():
+        app.get_service_costs({"Start": "target"}, {"Start": "compare"})
+
+    float_time = _best_time(run_float)
+    exact_time = _best_time(run_exact)
+    record_property("float_time", float_time)
+    record_property("exact_time", exact_time)
+
+    assert exact_time <= float_time * 4
@@ -1,10 +1,15 @@
+import gzip
 import os
+import time
 from datetime import datetime
 
 import pytest
+from botocore.exceptions import ClientError
 from botocore.stub import Stubber
 
-from s3_cost_report import app
+from s3_cost_report import app, fetch, sections, sinks, snapshots
+
+from .conftest import mock_ce_costs, mock_ce_response
 
 
 # fixtures for datetime processing around year boundaries
@@ -68,11 +73,37 @@ def test_report_periods(test_now, expected_target_period, expected_compare_perio
             assert found_compare == expected_compare_period
 
 
+@pytest.mark.parametrize(
+    "test_now,expected_period",
+    [
+        ("2020-12-02", {"Start": "2020-12-02", "End": "2021-01-01"}),
+        ("2020-01-31", {"Start": "2020-01-31", "End": "2020-02-01"}),
+        ("2020-02-02", {"Start": "2020-02-02", "End": "2020-03-01"}),
+    ],
+)
+def test_forecast_period(test_now, expected_period):
+    test_dt = datetime.fromisoformat(test_now)
+    assert app.forecast_period(test_dt) == expected_period
+
+
+def test_ce_workers(mocker):
+    mocker.patch.dict(os.environ, {"LOW_MEMORY": "false"})
+    os.environ.pop("CE_WORKERS", None)
+    assert app.ce_workers() == app.CE_WORKERS
+
+    mocker.patch.dict(os.environ, {"CE_WORKERS": "2"})
+    assert app.ce_workers() == 2
+
+    # low-memory mode runs one query at a time
+    mocker.patch.dict(os.environ, {"LOW_MEMORY": "true"})
+    assert app.ce_workers() == 1
+
+
 def test_service_costs(
     mocker,
     mock_ce_period,
-    mock_ce_service_target_data,
-    mock_ce_service_compare_data,
+    mock_ce_compare_period,
+    mock_ce_costs_all,
     mock_app_service_dict,
 ):
     env_vars = {
@@ -80,20 +111,14 @@ def test_service_costs(
     }
     mocker.patch.dict(os.environ, env_vars)
 
-    mocker.patch(
-        "s3_cost_report.ce.get_ce_service_costs",
-        side_effect=[
-            mock_ce_service_compare_data,
-            mock_ce_service_target_data,
-        ],
-    )
+    mocker.patch("s3_cost_report.ce.get_ce_costs", side_effect=mock_ce_costs_all)
 
     with Stubber(app.sts_client) as _sts:
         with Stubber(app.iam_client) as _iam:
             # target and compare periods are passed through to patched functions
             found_dict = app.get_service_costs(
                 mock_ce_period,
-                mock_ce_period,
+                mock_ce_compare_period,
             )
             assert found_dict == mock_app_service_dict
 
@@ -101,29 +126,336 @@ def test_service_costs(
 def test_s3_usage_costs(
     mocker,
     mock_app_s3_usage_dict,
-    mock_ce_s3_usage_target_data,
-    mock_ce_s3_usage_compare_data,
+    mock_ce_costs_all,
     mock_ce_period,
+    mock_ce_compare_period,
 ):
     env_vars = {
         "MINIMUM": "0"
     }
     mocker.patch.dict(os.environ, env_vars)
 
-    mocker.patch(
-        "s3_cost_report.ce.get_ce_s3_usage_costs",
-        side_effect=[
-            mock_ce_s3_usage_compare_data,
-            mock_ce_s3_usage_target_data,
-        ],
-    )
+    mocker.patch("s3_cost_report.ce.get_ce_costs", side_effect=mock_ce_costs_all)
 
     with Stubber(app.sts_client) as _sts:
         with Stubber(app.iam_client) as _iam:
 
-            # period input doesn't matter since it's only passed to patched functions
+            # periods are only passed to the patched function
             found_dict = app.get_s3_usage_costs(
                 mock_ce_period,
-                mock_ce_period,
+                mock_ce_compare_period,
             )
             assert found_dict == mock_app_s3_usage_dict
+
+
+def test_compare_snapshots(mocker, tmp_path, mock_app_service_dict, mock_app_s3_usage_dict):
+    mocker.patch.dict(os.environ, {"SNAPSHOT_DIR": str(tmp_path)})
+
+    december = {"Start": "2022-12-01", "End": "2023-01-01"}
+    january = {"Start": "2023-01-01", "End": "2023-02-01"}
+
+    # nothing to compare against on the first run
+    data = {"services": mock_app_service_dict, "s3_usage": mock_app_s3_usage_dict}
+    found_period, found_changes = app.compare_snapshots(december, data)
+    assert found_period is None
+    assert found_changes is None
+
+    # the next month's report isn't compared against the last one, since its
+    # changes are already in the month-over-month column
+    found = app.compare_snapshots(january, data)
+    assert found == (None, None)
+
+    # a service is restated when the report is run again for the same month
+    services = dict(mock_app_service_dict)
+    dropped = next(iter(services))
+    del services[dropped]
+    data = {"services": services, "s3_usage": mock_app_s3_usage_dict}
+    found_period, found_changes = app.compare_snapshots(january, data)
+    assert found_period == january
+    assert list(found_changes["services"]) == [dropped]
+    assert found_changes["s3_usage"] == {}
+
+
+def test_load_compare_totals(mocker, tmp_path):
+    mocker.patch.dict(os.environ, {"SNAPSHOT_DIR": str(tmp_path)})
+    december = {"Start": "2022-12-01", "End": "2023-01-01"}
+    november = {"Start": "2022-11-01", "End": "2022-12-01"}
+
+    store = snapshots.SnapshotStore(snapshots.FileStore(tmp_path))
+    store.save(november, {"services": {"ec2": 10**11}})
+
+    # only the snapshot of the compare period itself is used
+    assert app.load_compare_totals(december) == {}
+    assert app.load_compare_totals(november) == {"services": {"ec2": 10**11}}
+
+
+def test_build_report_compare_snapshot(mocker, tmp_path, mock_ce_costs_all):
+    mocker.patch.dict(os.environ, {"MINIMUM": "0.01", "SNAPSHOT_DIR": str(tmp_path)})
+    get_ce_costs = mocker.patch(
+        "s3_cost_report.ce.get_ce_costs", side_effect=mock_ce_costs_all
+    )
+
+    store = snapshots.SnapshotStore(snapshots.FileStore(tmp_path))
+    december = {"Start": "2022-12-01", "End": "2023-01-01"}
+    store.save(december, {"services": {"ec2": 15 * 10**10}, "s3_usage": {}})
+
+    report = app.build_report("test-account", datetime(2023, 2, 2))
+
+    # the compare period comes from the last report's snapshot
+    queried = {call.args[0]["Start"] for call in get_ce_costs.call_args_list}
+    assert queried == {"2023-01-01"}
+    assert "ec2\t$30.00\t100.00%\n" in report.text
+
+
+def test_compare_snapshots_store_errors(mocker, mock_app_service_dict):
+    class BrokenStore(snapshots.MemoryStore):
+        def list(self):
+            raise ConnectionError("test")
+
+        def put(self, name, data):
+            raise ConnectionError("test")
+
+    store = snapshots.SnapshotStore(BrokenStore())
+    mocker.patch("s3_cost_report.snapshots.from_environment", return_value=store)
+
+    # the report goes on without the changes section
+    data = {"services": mock_app_service_dict}
+    found = app.compare_snapshots(expected_target_dec, data)
+    assert found == (None, None)
+
+
+def test_compare_snapshots_bad_version(mocker, tmp_path, mock_app_service_dict):
+    mocker.patch.dict(os.environ, {"SNAPSHOT_DIR": str(tmp_path)})
+    (tmp_path / "2020-10-01.json.gz").write_bytes(
+        gzip.compress(b'{"version": 99}')
+    )
+
+    data = {"services": mock_app_service_dict}
+    found = app.compare_snapshots(expected_target_dec, data)
+    assert found == (None, None)
+
+    # this report's snapshot is still saved
+    assert "2020-11-01.json.gz" in snapshots.FileStore(tmp_path).list()
+
+
+def test_compare_snapshots_disabled(mocker, mock_app_service_dict, mock_app_s3_usage_dict):
+    mocker.patch.dict(os.environ, {}, clear=True)
+
+    data = {"services": mock_app_service_dict, "s3_usage": mock_app_s3_usage_dict}
+    found = app.compare_snapshots(expected_target_dec, data)
+    assert found == (None, None)
+
+
+def test_report_data_forecast(
+    mocker,
+    mock_ce_period,
+    mock_ce_compare_period,
+    mock_ce_costs_all,
+    mock_app_service_dict,
+    mock_app_s3_usage_dict,
+):
+    env_vars = {
+        "MINIMUM": "0.01"
+    }
+    mocker.patch.dict(os.environ, env_vars)
+
+    mocker.patch("s3_cost_report.ce.get_ce_costs", side_effect=mock_ce_costs_all)
+
+    # forecast every service, but none of the S3 usage types
+    def _forecast(period, cost_filter):
+        if "And" in cost_filter:
+            return None
+        return "99.5"
+
+    forecast = mocker.patch("s3_cost_report.ce.get_ce_forecast", side_effect=_forecast)
+
+    found = app.get_report_data(mock_ce_period, mock_ce_compare_period, mock_ce_period)
+    found_service, found_s3_usage = found["services"], found["s3_usage"]
+
+    # only keys with a total this month are forecast
+    expected_service = {
+        key: {**value, "forecast": 995000000000} if value["total"] else value
+        for key, value in mock_app_service_dict.items()
+    }
+    assert found_service == expected_service
+    assert not any("forecast" in value for value in found_s3_usage.values())
+
+    forecast_count = sum(1 for v in expected_service.values() if v["total"])
+    forecast_count += sum(1 for v in found_s3_usage.values() if v["total"])
+    assert forecast.call_count == forecast_count
+
+
+def test_report_data_no_forecast(
+    mocker,
+    mock_ce_period,
+    mock_ce_compare_period,
+    mock_ce_costs_all,
+    mock_app_service_dict,
+    mock_app_s3_usage_dict,
+):
+    env_vars = {
+        "MINIMUM": "0.01"
+    }
+    mocker.patch.dict(os.environ, env_vars)
+
+    mocker.patch("s3_cost_report.ce.get_ce_costs", side_effect=mock_ce_costs_all)
+    forecast = mocker.patch("s3_cost_report.ce.get_ce_forecast")
+
+    found = app.get_report_data(mock_ce_period, mock_ce_compare_period)
+
+    assert list(found) == ["services", "s3_usage"]
+    assert found["services"] == mock_app_service_dict
+    forecast.assert_not_called()
+
+    # rows are sorted for the tables, largest total first
+    assert list(found["services"]) == ["s3", "ec2", "rds"]
+
+
+def test_report_data_tag_section(mocker, mock_ce_period, mock_ce_compare_period):
+    env_vars = {
+        "MINIMUM": "0.01"
+    }
+    mocker.patch.dict(os.environ, env_vars)
+
+    projects = sections.from_config(
+        {
+            "name": "projects",
+            "title": "Break-down of total monthly costs by project:",
+            "header": "Project",
+            "group_by": {"Type": "TAG", "Key": "Project"},
+        }
+    )
+
+    target = mock_ce_period["Start"]
+    compare = mock_ce_compare_period["Start"]
+    mocker.patch(
+        "s3_cost_report.ce.get_ce_costs",
+        side_effect=mock_ce_costs(
+            {
+                ("Project", target): mock_ce_response(
+                    {"Project$alpha": 30.0, "Project$": 5.0}
+                ),
+                ("Project", compare): mock_ce_response({"Project$alpha": 20.0}),
+            }
+        ),
+    )
+    forecast = mocker.patch("s3_cost_report.ce.get_ce_forecast", return_value="1")
+
+    found = app.get_report_data(
+        mock_ce_period, mock_ce_compare_period, mock_ce_period, None, [projects]
+    )
+
+    # tag values are keyed without the tag key
+    assert list(found) == ["projects"]
+    assert found["projects"]["alpha"]["change"] == 0.5
+    assert found["projects"][""]["change"] == 1.0
+
+    # each value is forecast separately, untagged costs included
+    found_filters = sorted(
+        call.args[1]["Tags"]["MatchOptions"][0] for call in forecast.call_args_list
+    )
+    assert found_filters == ["ABSENT", "EQUALS"]
+
+
+@pytest.fixture()
+def mock_ce_costs_s3_failing(mock_ce_costs_all):
+    """Cost Explorer queries for S3 usage types fail"""
+
+    def _get_ce_costs(period, group_by, cost_filter=None, account_id=None):
+        if group_by["Key"] == "USAGE_TYPE":
+            raise ClientError(
+                {"Error": {"Code": "AccessDeniedException", "Message": "test"}},
+                "GetCostAndUsage",
+            )
+        return mock_ce_costs_all(period, group_by, cost_filter, account_id)
+
+    return _get_ce_costs
+
+
+def test_report_data_partial(
+    mocker,
+    mock_ce_period,
+    mock_ce_compare_period,
+    mock_ce_costs_s3_failing,
+    mock_app_service_dict,
+):
+    mocker.patch.dict(os.environ, {"MINIMUM": "0.01"})
+    mocker.patch("s3_cost_report.ce.get_ce_costs", side_effect=mock_ce_costs_s3_failing)
+
+    found = app.get_report_data(mock_ce_period, mock_ce_compare_period)
+
+    # the failed section is left out, the rest is still reported
+    assert found == {"services": mock_app_service_dict}
+
+
+def test_report_data_deadline(mocker, mock_ce_period, mock_ce_compare_period):
+    mocker.patch.dict(os.environ, {"MINIMUM": "0.01"})
+
+    def _hang(*args, **kwargs):
+        time.sleep(2)
+
+    mocker.patch("s3_cost_report.ce.get_ce_costs", side_effect=_hang)
+
+    start = time.monotonic()
+    with fetch.Fetcher(start + 0.2, hedge_after=None) as fetcher:
+        found = app.get_report_data(
+            mock_ce_period,
+            mock_ce_compare_period,
+            fetcher=fetcher,
+        )
+
+    assert found == {}
+    assert time.monotonic() - start < 1
+
+
+def test_build_report_partial(mocker, tmp_path, mock_ce_costs_s3_failing):
+    mocker.patch.dict(os.environ, {"MINIMUM": "0.01", "SNAPSHOT_DIR": str(tmp_path)})
+    mocker.patch("s3_cost_report.ce.get_ce_costs", side_effect=mock_ce_costs_s3_failing)
+
+    # without a snapshot, the section is marked as unavailable
+    report = app.build_report("test-account", datetime(2023, 2, 2))
+    assert report.subject.endswith("[partial]")
+    assert "Cost Explorer data is unavailable for S3 usage totals" in report.text
+    assert "AWS Service\tTotal" in report.text
+
+    # a partial report is not saved as a snapshot
+    assert snapshots.FileStore(tmp_path).list() == []
+
+    # with a snapshot, the last known totals are shown instead
+    store = snapshots.SnapshotStore(snapshots.FileStore(tmp_path))
+    december = {"Start": "2022-12-01", "End": "2023-01-01"}
+    store.save(december, {"services": {}, "s3_usage": {"type1": 10**11}})
+
+    report = app.build_report("test-account", datetime(2023, 2, 2))
+    assert "last known totals from the December 2022 report" in report.text
+    assert "type1\t$10.00\t" in report.text
+
+
+class MockContext:
+    def __init__(self, remaining):
+        self.remaining = remaining
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining
+
+
+def test_lambda_handler(mocker):
+    mocker.patch.dict(os.environ, {"FORECAST": "false"})
+    mocker.patch("s3_cost_report.app.get_account_name", return_value="test-account")
+    report = sinks.Report("2023-01-01", "subject", "html", "text")
+    build_report = mocker.patch("s3_cost_report.app.build_report", return_value=report)
+    dispatch = mocker.patch("s3_cost_report.sinks.dispatch", return_value={"ses": True})
+
+    start = time.monotonic()
+    app.lambda_handler({}, MockContext(120_000))
+
+    # queries get the run time less the time to render and deliver the report
+    fetch_deadline = build_report.call_args.kwargs["deadline"]
+    assert fetch_deadline - start == pytest.approx(120 - app.REPORT_RESERVE, abs=1)
+    dispatch_deadline = dispatch.call_args.args[2]
+    assert dispatch_deadline - start == pytest.approx(120 - app.EXIT_RESERVE, abs=1)
+
+    # fail the run if the report didn't go anywhere
+    dispatch.return_value = {"ses": RuntimeError("test")}
+    with pytest.raises(RuntimeError):
+        app.lambda_handler({}, MockContext(120_000))
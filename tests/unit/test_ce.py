@@ -1,7 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
+from botocore.exceptions import ClientError
 from botocore.stub import Stubber
 
-from s3_cost_report import ce
+from s3_cost_report import ce, fetch, sections
+
+
+def test_ce_single_attempt():
+    # retries are left to the fetch layer
+    assert ce.ce_client.meta.config.retries["total_max_attempts"] == 1
 
 
 def test_ce_service(mock_ce_period, mock_ce_service_target_data):
@@ -24,3 +32,138 @@ def test_ce_s3_usage(mock_ce_period, mock_ce_s3_usage_target_data):
 
         # assert that the client function was called
         _stub.assert_no_pending_responses()
+
+
+def test_ce_costs(mock_ce_period):
+    group_by = {"Type": "COST_CATEGORY", "Key": "Team"}
+    cost_filter = sections.SERVICES.forecast_filter("ec2")
+    response = {
+        "GroupDefinitions": [group_by],
+        "ResultsByTime": [],
+    }
+
+    with Stubber(ce.ce_client) as _stub:
+        _stub.add_response(
+            "get_cost_and_usage",
+            response,
+            {
+                "TimePeriod": mock_ce_period,
+                "Granularity": "MONTHLY",
+                "Metrics": [ce.cost_metric],
+                "GroupBy": [group_by],
+                "Filter": {"And": [cost_filter, ce.linked_account_filter("111")]},
+            },
+        )
+
+        ce.get_ce_costs(mock_ce_period, group_by, cost_filter, "111")
+
+        _stub.assert_no_pending_responses()
+
+
+def test_ce_forecast(mocker, mock_ce_period):
+    mocker.patch.dict(ce._forecast_cache, clear=True)
+    cost_filter = sections.SERVICES.forecast_filter("ec2")
+    response = {
+        "Total": {"Amount": "12.3", "Unit": "USD"},
+        "ForecastResultsByTime": [],
+    }
+
+    with Stubber(ce.ce_client) as _stub:
+        _stub.add_response(
+            "get_cost_forecast",
+            response,
+            {
+                "TimePeriod": mock_ce_period,
+                "Granularity": "MONTHLY",
+                "Metric": ce.forecast_metric,
+                "Filter": cost_filter,
+            },
+        )
+
+        assert ce.get_ce_forecast(mock_ce_period, cost_filter) == "12.3"
+
+        # the second call is served from the cache
+        assert ce.get_ce_forecast(mock_ce_period, cost_filter) == "12.3"
+
+        _stub.assert_no_pending_responses()
+
+
+def test_ce_forecast_unavailable(mocker, mock_ce_period):
+    mocker.patch.dict(ce._forecast_cache, clear=True)
+    cost_filter = sections.S3_USAGE.forecast_filter("type1")
+
+    with Stubber(ce.ce_client) as _stub:
+        _stub.add_client_error(
+            "get_cost_forecast", service_error_code="DataUnavailableException"
+        )
+        _stub.add_client_error(
+            "get_cost_forecast", service_error_code="LimitExceededException"
+        )
+
+        # not enough data is cached for the day
+        assert ce.get_ce_forecast(mock_ce_period, cost_filter) is None
+        assert ce.get_ce_forecast(mock_ce_period, cost_filter) is None
+
+        # other errors are raised for the caller to retry, and not cached
+        with pytest.raises(ClientError):
+            ce.get_ce_forecast(mock_ce_period)
+        _stub.assert_no_pending_responses()
+
+
+def test_ce_forecast_cache_expires(mocker, mock_ce_period):
+    mocker.patch.dict(ce._forecast_cache, clear=True)
+    ce._forecast_cache[("2000-01-01", "[]")] = "1.0"
+    response = {
+        "Total": {"Amount": "12.3", "Unit": "USD"},
+        "ForecastResultsByTime": [],
+    }
+
+    with Stubber(ce.ce_client) as _stub:
+        _stub.add_response("get_cost_forecast", response)
+
+        assert ce.get_ce_forecast(mock_ce_period) == "12.3"
+
+        _stub.assert_no_pending_responses()
+
+    # forecasts from other days are dropped
+    assert len(ce._forecast_cache) == 1
+    assert ("2000-01-01", "[]") not in ce._forecast_cache
+
+
+def test_ce_forecast_threads(mocker, mock_ce_period):
+    mocker.patch.dict(ce._forecast_cache, clear=True)
+    response = {
+        "Total": {"Amount": "12.3", "Unit": "USD"},
+        "ForecastResultsByTime": [],
+    }
+    mocker.patch.object(ce.ce_client, "get_cost_forecast", return_value=response)
+
+    def forecast(i):
+        cost_filter = sections.SERVICES.forecast_filter(f"service-{i}")
+        return ce.get_ce_forecast(mock_ce_period, cost_filter)
+
+    # the cache is shared by the threads querying forecasts
+    with ThreadPoolExecutor(8) as pool:
+        found = list(pool.map(forecast, range(2000)))
+
+    assert found == ["12.3"] * 2000
+    assert len(ce._forecast_cache) == 2000
+
+
+def test_ce_forecast_throttled(mocker, mock_ce_period):
+    mocker.patch.dict(ce._forecast_cache, clear=True)
+    breaker = fetch.CircuitBreaker()
+    breaker.failure()
+
+    with Stubber(ce.ce_client) as _stub:
+        _stub.add_client_error(
+            "get_cost_forecast", service_error_code="LimitExceededException"
+        )
+
+        fetcher = fetch.Fetcher(retries=0, breaker=breaker)
+        with pytest.raises(ClientError):
+            fetcher.call(ce.get_ce_forecast, mock_ce_period, None)
+        fetcher.close()
+
+    # a throttled forecast counts against the circuit
+    assert breaker.failures == 2
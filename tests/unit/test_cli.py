@@ -0,0 +1,136 @@
+import logging
+import os
+from datetime import date
+
+import pytest
+
+from s3_cost_report import cli, sinks
+
+
+def fake_job(job, output_dir):
+    """Stand-in for cli.run_job that can be pickled into worker processes"""
+    if job.account == "broken":
+        raise RuntimeError("test failure")
+    return job, 0.0
+
+
+def logging_job(job, output_dir):
+    """Stand-in for cli.run_job that logs at DEBUG and INFO level"""
+    log = logging.getLogger("s3_cost_report.app")
+    log.debug(f"debug {job.account}")
+    log.info(f"info {job.account}")
+    return job, 0.0
+
+
+def test_month_range():
+    found = cli.month_range(date(2022, 11, 1), date(2023, 2, 1))
+    assert found == [
+        date(2022, 11, 1),
+        date(2022, 12, 1),
+        date(2023, 1, 1),
+        date(2023, 2, 1),
+    ]
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        ("111111111111", ("111111111111", "111111111111")),
+        ("111111111111:dev", ("111111111111", "dev")),
+    ],
+)
+def test_parse_account(value, expected):
+    assert cli.parse_account(value) == expected
+
+
+def test_build_jobs():
+    months = [date(2023, 1, 1), date(2023, 2, 1)]
+
+    found = cli.build_jobs([], months, "my-account")
+    assert found == [
+        cli.Job(None, "my-account", date(2023, 1, 1)),
+        cli.Job(None, "my-account", date(2023, 2, 1)),
+    ]
+
+    found = cli.build_jobs([("111", "dev"), ("222", "prod")], months, None)
+    assert len(found) == 4
+    assert found[-1] == cli.Job("222", "prod", date(2023, 2, 1))
+
+
+def test_parse_args():
+    args = cli.parse_args(
+        ["--start", "2023-01", "--account", "111:dev", "--workers", "2"]
+    )
+    assert args.start == date(2023, 1, 1)
+    assert args.end is None
+    assert args.account == [("111", "dev")]
+    assert args.workers == 2
+
+    with pytest.raises(SystemExit):
+        cli.parse_args(["--start", "January"])
+
+
+def test_run_job(mocker, tmp_path):
+    report = sinks.Report("2022-12-01", "subject", "<html>test</html>", "test")
+    build_report = mocker.patch(
+        "s3_cost_report.app.build_report", return_value=report
+    )
+
+    job = cli.Job("111", "dev", date(2022, 12, 1))
+    found_job, _ = cli.run_job(job, tmp_path)
+
+    assert found_job == job
+
+    # a December report runs as if it were the first of January
+    build_report.assert_called_once_with("dev", date(2023, 1, 1), "111", snapshot=False)
+
+    assert (tmp_path / "dev" / "2022-12-01.html").read_text() == report.html
+    assert (tmp_path / "dev" / "2022-12-01.txt").read_text() == report.text
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_run_jobs(tmp_path, workers):
+    months = [date(2023, 1, 1), date(2023, 2, 1)]
+    jobs = cli.build_jobs([("111", "dev"), ("222", "broken")], months, None)
+
+    failed = cli.run_jobs(jobs, tmp_path, workers, job_func=fake_job)
+
+    assert sorted(failed) == sorted(job for job in jobs if job.account == "broken")
+
+
+def test_worker_logging(tmp_path, capfd):
+    jobs = cli.build_jobs([("111", "dev")], [date(2023, 1, 1)], None)
+
+    cli.run_jobs(jobs, tmp_path, 2, job_func=logging_job)
+
+    # worker processes log progress, but not the package's debug output
+    err = capfd.readouterr().err
+    assert "info dev" in err
+    assert "debug dev" not in err
+
+
+def test_main(mocker, tmp_path):
+    mocker.patch.dict(os.environ, {})
+    run_jobs = mocker.patch("s3_cost_report.cli.run_jobs", return_value=[])
+
+    found = cli.main(
+        [
+            "--start", "2023-01",
+            "--end", "2023-03",
+            "--account", "111:dev",
+            "--output-dir", str(tmp_path),
+            "--workers", "4",
+            "--minimum", "0",
+        ]
+    )
+
+    assert found == 0
+    assert os.environ["MINIMUM"] == "0"
+
+    # each worker process runs Cost Explorer queries one at a time
+    assert os.environ["CE_WORKERS"] == str(cli.BATCH_CE_WORKERS)
+
+    jobs, output_dir, workers = run_jobs.call_args.args
+    assert len(jobs) == 3
+    assert output_dir == tmp_path
+    assert workers == 4
@@ -0,0 +1,181 @@
+import threading
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+from s3_cost_report import fetch
+
+
+def client_error(code):
+    return ClientError({"Error": {"Code": code, "Message": "test"}}, "GetCostAndUsage")
+
+
+class FlakyQuery:
+    """Fail with the given errors, then return a result"""
+
+    __name__ = "flaky"
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "result"
+
+
+@pytest.fixture()
+def breaker():
+    return fetch.CircuitBreaker(threshold=2, reset_after=0.1)
+
+
+@pytest.mark.parametrize(
+    "error,expected",
+    [
+        (client_error("ThrottlingException"), True),
+        (client_error("LimitExceededException"), True),
+        (client_error("AccessDeniedException"), False),
+        (TimeoutError(), True),
+        (KeyError("Groups"), False),
+    ],
+)
+def test_retryable(error, expected):
+    assert fetch.retryable(error) == expected
+
+
+def test_circuit_breaker(breaker):
+    breaker.failure()
+    assert breaker.allow()
+
+    # open after the threshold
+    breaker.failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+
+    # a single trial call is let through after a while
+    time.sleep(0.15)
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.success()
+    assert not breaker.is_open
+    assert breaker.allow()
+
+
+def test_retry(breaker):
+    query = FlakyQuery(client_error("ThrottlingException"))
+
+    with fetch.Fetcher(backoff=0, breaker=breaker) as fetcher:
+        assert fetcher.call(query) == "result"
+
+    assert query.calls == 2
+    assert breaker.failures == 0
+
+
+def test_retries_exhausted(breaker):
+    errors = [client_error("ThrottlingException")] * 3
+    query = FlakyQuery(*errors)
+
+    with fetch.Fetcher(retries=1, backoff=0, breaker=breaker) as fetcher:
+        with pytest.raises(ClientError):
+            fetcher.call(query)
+
+    assert query.calls == 2
+
+
+def test_not_retried(breaker):
+    query = FlakyQuery(client_error("AccessDeniedException"))
+
+    with fetch.Fetcher(backoff=0, breaker=breaker) as fetcher:
+        with pytest.raises(ClientError):
+            fetcher.call(query)
+
+    # errors that won't go away on their own don't count against the circuit
+    assert query.calls == 1
+    assert breaker.failures == 0
+
+
+def test_trial_not_retried(breaker):
+    breaker.failure()
+    breaker.failure()
+    time.sleep(0.15)
+
+    with fetch.Fetcher(backoff=0, breaker=breaker) as fetcher:
+        with pytest.raises(ClientError):
+            fetcher.call(FlakyQuery(client_error("ValidationException")))
+
+        # a trial call with an error that doesn't count against the circuit
+        # lets the next call be the trial
+        assert fetcher.call(FlakyQuery()) == "result"
+
+    assert not breaker.is_open
+
+
+def test_circuit_open(breaker):
+    errors = [client_error("ThrottlingException")] * 2
+    query = FlakyQuery(*errors)
+
+    with fetch.Fetcher(retries=5, backoff=0, breaker=breaker) as fetcher:
+        with pytest.raises(fetch.CircuitOpenError):
+            fetcher.call(query)
+
+        # later queries fail fast without being sent
+        other = FlakyQuery()
+        with pytest.raises(fetch.CircuitOpenError):
+            fetcher.call(other)
+        assert other.calls == 0
+
+
+def test_hedged(breaker):
+    calls = []
+    lock = threading.Lock()
+
+    def slow_once():
+        with lock:
+            calls.append(time.monotonic())
+            first = len(calls) == 1
+        if first:
+            time.sleep(2)
+            return "slow"
+        return "fast"
+
+    with fetch.Fetcher(hedge_after=0.05, breaker=breaker) as fetcher:
+        start = time.monotonic()
+        assert fetcher.call(slow_once) == "fast"
+        assert time.monotonic() - start < 1
+
+    assert len(calls) == 2
+
+
+def test_no_hedging_after_throttling(breaker):
+    calls = []
+
+    def throttled_then_slow():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise client_error("ThrottlingException")
+        time.sleep(0.3)
+        return "result"
+
+    with fetch.Fetcher(hedge_after=0.05, backoff=0, breaker=breaker) as fetcher:
+        assert fetcher.call(throttled_then_slow) == "result"
+
+    # the slow retry is waited for rather than sent again
+    assert len(calls) == 2
+
+
+def test_deadline(breaker):
+    def hang():
+        time.sleep(2)
+
+    start = time.monotonic()
+    with fetch.Fetcher(start + 0.2, hedge_after=0.05, breaker=breaker) as fetcher:
+        with pytest.raises(TimeoutError):
+            fetcher.call(hang)
+        assert fetcher.remaining() == 0
+
+    # abandoned at the deadline, without waiting for the query to finish
+    assert time.monotonic() - start < 1
@@ -0,0 +1,69 @@
+import pytest
+
+from s3_cost_report import index
+
+target = {"ec2": 300, "s3": 100, "new": 50}
+compare = {"ec2": 200, "s3": 150, "gone": 80}
+history = [{"ec2": 100, "old": 10}]
+
+
+def test_full_outer_join():
+    found = index.CostIndex(target, compare, history)
+
+    assert len(found) == 4
+    assert found.period_count == 3
+    assert found.keys() == ["ec2", "s3", "new", "gone"]
+    assert "gone" in found
+
+    # older periods are joined on the keys of the target and compare periods
+    assert "old" not in found
+
+    assert found["ec2"] == index.Row("ec2", (300, 200, 100), 0.5, 100)
+    assert found["s3"] == index.Row("s3", (100, 150, 0), -50 / 150, -50)
+    assert found["new"] == index.Row("new", (50, 0, 0), 1.0, 50)
+    assert found["gone"] == index.Row("gone", (0, 80, 0), -1.0, -80)
+
+
+def test_to_dict():
+    found = index.CostIndex(target, compare).to_dict()
+
+    assert found == {
+        "ec2": {"total": 300, "change": 0.5},
+        "s3": {"total": 100, "change": -50 / 150},
+        "new": {"total": 50, "change": 1.0},
+        "gone": {"total": 0, "change": -1.0},
+    }
+
+
+def test_no_compare():
+    found = index.CostIndex(target)
+
+    assert found.keys() == ["ec2", "s3", "new"]
+    assert all(row.change == 1.0 for row in found.rows())
+
+
+
+def test_minimum():
+    found = index.CostIndex({"ec2": 300, "s3": 5}, {"s3": 20, "gone": 80}, minimum=10)
+
+    # keys under the minimum are dropped rather than shown as a 100% decrease
+    assert found.keys() == ["ec2", "gone"]
+    assert found["gone"] == index.Row("gone", (0, 80), -1.0, -80)
+
+
+@pytest.mark.parametrize(
+    "order,reverse,expected",
+    [
+        ("key", False, ["ec2", "gone", "new", "s3"]),
+        ("total", True, ["ec2", "s3", "new", "gone"]),
+        ("delta", False, ["gone", "s3", "new", "ec2"]),
+    ],
+)
+def test_sorted(order, reverse, expected):
+    found = index.CostIndex(target, compare)
+
+    assert found.keys(order, reverse) == expected
+    assert list(found.to_dict(order, reverse)) == expected
+
+    # the sorted keys are computed once and reused
+    assert found.keys(order, reverse) is found.keys(order, reverse)
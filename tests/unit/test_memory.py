@@ -0,0 +1,107 @@
+import os
+from datetime import datetime
+
+import pytest
+
+from s3_cost_report import app, memory, ses
+
+from .conftest import mock_ce_response
+
+# Size of the synthetic dataset for the memory ceiling test
+SYNTHETIC_ROWS = 20_000
+
+# Ceiling on peak traced memory for any stage of the synthetic run. One raw
+# response for the synthetic dataset takes about 15 MB, so the fetch stage
+# goes over the ceiling if responses are held on to after they're parsed.
+SYNTHETIC_CEILING_MB = "40"
+
+
+def test_low_memory(mocker):
+    mocker.patch.dict(os.environ, {"LOW_MEMORY": "true"})
+    assert memory.low_memory()
+    assert memory.body_limit() == memory.BODY_LIMIT
+
+    mocker.patch.dict(os.environ, {"LOW_MEMORY": "false"})
+    assert not memory.low_memory()
+    assert memory.body_limit() is None
+
+
+def test_log_preview(mocker):
+    text = "x" * (memory.DEBUG_LOG_LIMIT + 1)
+
+    mocker.patch.dict(os.environ, {"LOW_MEMORY": "false"})
+    assert memory.log_preview(text) == text
+
+    mocker.patch.dict(os.environ, {"LOW_MEMORY": "true"})
+    found = memory.log_preview(text)
+    assert found.startswith("x" * memory.DEBUG_LOG_LIMIT + "...")
+    assert found.endswith(f"({len(text)} characters)")
+
+
+def test_stage():
+    # stages are not tracked outside of a tracked run
+    with memory.stage("untracked"):
+        pass
+    assert "untracked" not in memory.peaks
+
+    with memory.tracking(enabled=True):
+        with memory.stage("small"):
+            _small = bytearray(1024)
+        with memory.stage("large"):
+            _large = bytearray(4 * 2**20)
+
+    assert memory.peaks["small"] < 2**20
+    assert memory.peaks["large"] >= 4 * 2**20
+
+
+def test_report_buffer():
+    output = ses.ReportBuffer(limit=10, notice="!")
+
+    output.write("12345")
+    output.write("678")
+    output.write("too long")
+    output.write("ok")
+
+    assert output.truncated
+    assert output.getvalue() == "12345678!"
+
+
+def test_peak_under_ceiling(mocker, record_property):
+    env_vars = {
+        "MINIMUM": "0",
+        "LOW_MEMORY": "true",
+        "MEMORY_CEILING_MB": SYNTHETIC_CEILING_MB,
+    }
+    mocker.patch.dict(os.environ, env_vars)
+    os.environ.pop("SNAPSHOT_DIR", None)
+    os.environ.pop("SNAPSHOT_BUCKET", None)
+
+    scales = {
+        ("SERVICE", "2023-01-01"): 1.37,
+        ("SERVICE", "2022-12-01"): 1.11,
+        ("USAGE_TYPE", "2023-01-01"): 0.73,
+        ("USAGE_TYPE", "2022-12-01"): 0.51,
+    }
+
+    # build each response when it is queried, inside the tracked run, so
+    # that the fetch stage only stays under the ceiling if responses are
+    # released once parsed
+    def _get_ce_costs(period, group_by, cost_filter=None, account_id=None):
+        scale = scales[(group_by["Key"], period["Start"])]
+        return mock_ce_response(
+            {f"key-{i:06}": f"{i * scale:.10f}" for i in range(SYNTHETIC_ROWS)}
+        )
+
+    mocker.patch("s3_cost_report.ce.get_ce_costs", side_effect=_get_ce_costs)
+
+    with memory.tracking():
+        report = app.build_report("test-account", datetime(2023, 2, 2))
+
+    for stage, peak in memory.peaks.items():
+        record_property(f"{stage}_peak_mb", round(peak / 2**20, 1))
+    assert set(memory.peaks) == {"fetch", "snapshot", "render"}
+    assert all(peak < memory.ceiling() for peak in memory.peaks.values())
+
+    # the bodies are rendered, but capped
+    assert len(report.html) <= memory.BODY_LIMIT + 100
+    assert len(report.text) <= memory.BODY_LIMIT + 100
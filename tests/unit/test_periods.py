@@ -0,0 +1,313 @@
+import os
+import statistics
+import time
+import timeit
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from s3_cost_report import app, periods, sinks, snapshots
+
+from .conftest import benchmark, mock_ce_response
+
+# Every month from the start of this year to the end of the last one is
+# checked, and the end-to-end run is repeated for each
+FIRST_YEAR = 1970
+LAST_YEAR = 2039
+
+# Latency budget for one stubbed end-to-end run, in seconds (benchmark only)
+RUN_LATENCY = 0.05
+
+
+def _months():
+    return [
+        date(year, month, 1)
+        for year in range(FIRST_YEAR, LAST_YEAR + 1)
+        for month in range(1, 13)
+    ]
+
+
+def _legacy_report_periods(today):
+    """The special-cased f-string calculation that `periods` replaced"""
+    target_period = {}
+    compare_period = {}
+
+    if today.month == 1:
+        target_period["Start"] = f"{today.year - 1}-12-01"
+        target_period["End"] = f"{today.year}-01-01"
+        compare_period["Start"] = f"{today.year - 1}-11-01"
+        compare_period["End"] = f"{today.year - 1}-12-01"
+    elif today.month == 2:
+        target_period["Start"] = f"{today.year}-01-01"
+        target_period["End"] = f"{today.year}-02-01"
+        compare_period["Start"] = f"{today.year - 1}-12-01"
+        compare_period["End"] = f"{today.year}-01-01"
+    else:
+        target_period["Start"] = f"{today.year}-{(today.month - 1):02}-01"
+        target_period["End"] = f"{today.year}-{today.month:02}-01"
+        compare_period["Start"] = f"{today.year}-{(today.month - 2):02}-01"
+        compare_period["End"] = f"{today.year}-{(today.month - 1):02}-01"
+
+    return target_period, compare_period
+
+
+def _previous_month(day):
+    """First day of the month before, by date arithmetic"""
+    return (day.replace(day=1) - timedelta(days=1)).replace(day=1)
+
+
+@pytest.mark.parametrize("day", [1, 2, 15, 28])
+def test_matches_legacy(day):
+    for month in _months():
+        today = month.replace(day=day)
+        assert periods.report_periods(today) == _legacy_report_periods(today)
+
+
+def test_month_properties():
+    for month in _months():
+        today = datetime(month.year, month.month, 2, 10, 30)
+        target, compare = periods.report_periods(today)
+
+        # the target is the whole month before today, the compare the one
+        # before that, and they are contiguous
+        assert target["End"] == month.isoformat()
+        assert target["Start"] == _previous_month(month).isoformat()
+        assert compare["End"] == target["Start"]
+        assert compare["Start"] == _previous_month(_previous_month(month)).isoformat()
+
+        forecast = periods.forecast_period(today)
+        assert forecast["Start"] == today.date().isoformat()
+        next_month = (month + timedelta(days=31)).replace(day=1)
+        assert forecast["End"] == next_month.isoformat()
+
+
+def test_outside_calendar_table():
+    assert periods.period(date(1969, 12, 5)) == {
+        "Start": "1969-12-01",
+        "End": "1970-01-01",
+    }
+    assert periods.period(date(2100, 1, 5), offset=-1) == {
+        "Start": "2099-12-01",
+        "End": "2100-01-01",
+    }
+    assert periods.period(date(2150, 12, 5)) == {
+        "Start": "2150-12-01",
+        "End": "2151-01-01",
+    }
+
+
+@pytest.mark.parametrize(
+    "offset,expected",
+    [
+        (0, {"Start": "2023-03-01", "End": "2023-04-01"}),
+        (-3, {"Start": "2022-12-01", "End": "2023-01-01"}),
+        (-15, {"Start": "2021-12-01", "End": "2022-01-01"}),
+        (10, {"Start": "2024-01-01", "End": "2024-02-01"}),
+    ],
+)
+def test_month_offsets(offset, expected):
+    assert periods.period(date(2023, 3, 14), offset=offset) == expected
+
+
+@pytest.mark.parametrize(
+    "today,fiscal_start,expected_target,expected_compare",
+    [
+        (
+            date(2023, 4, 2),
+            1,
+            {"Start": "2023-01-01", "End": "2023-04-01"},
+            {"Start": "2022-10-01", "End": "2023-01-01"},
+        ),
+        (
+            date(2023, 2, 2),
+            1,
+            {"Start": "2022-10-01", "End": "2023-01-01"},
+            {"Start": "2022-07-01", "End": "2022-10-01"},
+        ),
+        # a fiscal year starting in October has quarters starting in
+        # October, January, April and July
+        (
+            date(2023, 11, 2),
+            10,
+            {"Start": "2023-07-01", "End": "2023-10-01"},
+            {"Start": "2023-04-01", "End": "2023-07-01"},
+        ),
+        # a fiscal year starting in February
+        (
+            date(2023, 1, 15),
+            2,
+            {"Start": "2022-08-01", "End": "2022-11-01"},
+            {"Start": "2022-05-01", "End": "2022-08-01"},
+        ),
+    ],
+)
+def test_quarters(today, fiscal_start, expected_target, expected_compare):
+    found_target, found_compare = periods.report_periods(
+        today, "QUARTER", fiscal_start=fiscal_start
+    )
+    assert found_target == expected_target
+    assert found_compare == expected_compare
+
+
+@pytest.mark.parametrize("fiscal_start", range(1, 13))
+def test_quarter_properties(fiscal_start):
+    for month in _months():
+        target, compare = periods.report_periods(
+            month, "QUARTER", fiscal_start=fiscal_start
+        )
+        start = date.fromisoformat(target["Start"])
+
+        # quarters are three months long, contiguous, aligned to the fiscal
+        # year, and the target ends on or before today
+        assert (start.month - fiscal_start) % 3 == 0
+        assert periods.period(start, offset=3)["Start"] == target["End"]
+        assert compare["End"] == target["Start"]
+        current = periods.period(start, "QUARTER", 1, fiscal_start)
+        assert current["Start"] == target["End"]
+        assert current["Start"] <= month.isoformat() < current["End"]
+
+
+def test_weeks():
+    # a Thursday
+    today = date(2023, 1, 5)
+
+    found_target, found_compare = periods.report_periods(today, "WEEK")
+    assert found_target == {"Start": "2022-12-26", "End": "2023-01-02"}
+    assert found_compare == {"Start": "2022-12-19", "End": "2022-12-26"}
+
+    # weeks starting on Sunday
+    found_target, _ = periods.report_periods(today, "WEEK", week_start=6)
+    assert found_target == {"Start": "2022-12-25", "End": "2023-01-01"}
+
+    assert periods.forecast_period(today, "WEEK") == {
+        "Start": "2023-01-05",
+        "End": "2023-01-09",
+    }
+
+
+def test_week_properties():
+    day = date(FIRST_YEAR, 1, 1)
+    while day.year < FIRST_YEAR + 5:
+        target, compare = periods.report_periods(day, "WEEK")
+        start = date.fromisoformat(target["Start"])
+
+        assert start.weekday() == 0
+        assert start < day <= start + timedelta(days=13)
+        assert compare["End"] == target["Start"]
+        day += timedelta(days=1)
+
+
+def test_unsupported_granularity():
+    with pytest.raises(ValueError):
+        periods.period(date(2023, 1, 5), "FORTNIGHT")
+
+
+@benchmark
+def test_benchmark_report_periods(record_property):
+    months = _months()
+
+    def run(func):
+        return min(
+            timeit.repeat(lambda: [func(month) for month in months], number=1, repeat=7)
+        )
+
+    legacy_time = run(_legacy_report_periods)
+    found_time = run(periods.report_periods)
+    record_property("legacy_time", legacy_time)
+    record_property("table_time", found_time)
+
+    # the table lookup is no slower than the special cases it replaced
+    assert found_time <= legacy_time
+
+
+def _months_since_base(day):
+    # the month before the first report targets is month one
+    return periods.month_index(day) - periods.month_index(date(FIRST_YEAR - 1, 10, 1))
+
+
+def _ce_costs(period, group_by, cost_filter=None, account_id=None):
+    """Stubbed Cost Explorer totals that grow by a dollar every month"""
+    amount = _months_since_base(date.fromisoformat(period["Start"]))
+    return mock_ce_response({"ec2": amount, "s3": 2 * amount})
+
+
+class FrozenDatetime(datetime):
+    """Stand-in for datetime in the app, with the time frozen at 'frozen'"""
+
+    frozen = None
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.frozen
+
+
+class FakeContext:
+    def get_remaining_time_in_millis(self):
+        return 300_000
+
+
+def _stub_pipeline(mocker):
+    """
+    Stub Cost Explorer and the account name, freeze the app's clock, and
+    deliver reports to a store in memory, which is returned
+    """
+    mocker.patch.dict(os.environ, {"MINIMUM": "0.01"})
+    for name in ("REPORT_SECTIONS", "LOW_MEMORY", "FORECAST", "SNAPSHOT_BUCKET"):
+        os.environ.pop(name, None)
+    os.environ.pop("SNAPSHOT_DIR", None)
+
+    mocker.patch("s3_cost_report.ce.get_ce_costs", side_effect=_ce_costs)
+    mocker.patch("s3_cost_report.app.get_account_name", return_value="test-account")
+    mocker.patch("s3_cost_report.app.datetime", FrozenDatetime)
+
+    store = snapshots.MemoryStore()
+    sink = sinks.StoreSink(store)
+    mocker.patch("s3_cost_report.sinks.from_environment", return_value=[sink])
+    return store
+
+
+def _run_handler(month):
+    """Run the lambda on the second day of the month"""
+    FrozenDatetime.frozen = FrozenDatetime(month.year, month.month, 2, 10, 30)
+    app.lambda_handler({}, FakeContext())
+
+
+def test_end_to_end_every_month(mocker):
+    store = _stub_pipeline(mocker)
+    dispatch = mocker.spy(sinks, "dispatch")
+
+    for month in _months():
+        _run_handler(month)
+
+        target = _previous_month(month)
+        total = _months_since_base(target)
+        change = 1 / (total - 1)
+
+        # the report for the month before is delivered
+        report = dispatch.call_args.args[1]
+        assert report.subject.endswith(f" {target:%B %Y})")
+        text = store.get(f"{target.isoformat()}.txt").decode("utf-8")
+        assert f"ec2\t${total}.00\t{change:.2%}\n" in text
+        assert f"s3\t${2 * total}.00\t{change:.2%}\n" in text
+        html = store.get(f"{target.isoformat()}.html").decode("utf-8")
+        assert f"<td>${2 * total}.00</td>" in html
+
+    assert len(store.list()) == 2 * len(_months())
+
+
+@benchmark
+def test_benchmark_end_to_end(mocker, record_property):
+    _stub_pipeline(mocker)
+
+    latencies = []
+    for month in _months():
+        start = time.perf_counter()
+        _run_handler(month)
+        latencies.append(time.perf_counter() - start)
+
+    median = statistics.median(latencies)
+    record_property("median_latency", median)
+    record_property("p95_latency", statistics.quantiles(latencies, n=20)[-1])
+    record_property("max_latency", max(latencies))
+
+    assert median < RUN_LATENCY
@@ -0,0 +1,82 @@
+import json
+import os
+
+import pytest
+
+from s3_cost_report import ce, sections
+
+projects_config = {
+    "name": "projects",
+    "title": "Break-down of total monthly costs by project:",
+    "header": "Project",
+    "group_by": {"Type": "TAG", "Key": "Project"},
+}
+
+
+def test_from_config():
+    found = sections.from_config(projects_config)
+    assert found.name == "projects"
+    assert found.filter is None
+    assert found.empty() == "Project totals"
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {**projects_config, "colour": "red"},
+        {key: value for key, value in projects_config.items() if key != "title"},
+        {**projects_config, "group_by": {"Type": "TAG"}},
+        {**projects_config, "group_by": {"Type": "REGION", "Key": "x"}},
+    ],
+)
+def test_from_config_invalid(config):
+    with pytest.raises(ValueError):
+        sections.from_config(config)
+
+
+def test_from_environment(mocker):
+    mocker.patch.dict(os.environ, {"REPORT_SECTIONS": ""})
+    assert sections.from_environment() == list(sections.DEFAULT_SECTIONS)
+
+    mocker.patch.dict(os.environ, {"REPORT_SECTIONS": json.dumps([projects_config])})
+    found = sections.from_environment()
+    assert [section.name for section in found] == ["services", "s3_usage", "projects"]
+
+    duplicate = {**projects_config, "name": "services"}
+    mocker.patch.dict(os.environ, {"REPORT_SECTIONS": json.dumps([duplicate])})
+    with pytest.raises(ValueError):
+        sections.from_environment()
+
+
+def test_tag_values():
+    projects = sections.from_config(projects_config)
+
+    assert projects.value("Project$alpha") == "alpha"
+    assert projects.value("Project$") == ""
+    assert projects.label("alpha") == "alpha"
+    assert projects.label("") == "(no Project)"
+
+    assert projects.forecast_filter("alpha") == {
+        "Tags": {"Key": "Project", "Values": ["alpha"], "MatchOptions": ["EQUALS"]}
+    }
+    assert projects.forecast_filter("") == {
+        "Tags": {"Key": "Project", "MatchOptions": ["ABSENT"]}
+    }
+
+
+def test_default_forecast_filters():
+    assert sections.SERVICES.forecast_filter("ec2") == {
+        "Dimensions": {"Key": "SERVICE", "Values": ["ec2"], "MatchOptions": ["EQUALS"]}
+    }
+    assert sections.S3_USAGE.forecast_filter("type1") == {
+        "And": [
+            ce.s3_service_filter,
+            {
+                "Dimensions": {
+                    "Key": "USAGE_TYPE",
+                    "Values": ["type1"],
+                    "MatchOptions": ["EQUALS"],
+                }
+            },
+        ]
+    }
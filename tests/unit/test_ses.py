@@ -3,7 +3,7 @@ import os
 import pytest
 from botocore.stub import Stubber
 
-from s3_cost_report import ses
+from s3_cost_report import sections, ses
 
 
 def test_send_email(mocker, mock_ses_response):
@@ -38,3 +38,100 @@ def test_email_body(mocker, mock_app_service_dict, mock_app_s3_usage_dict):
     html, text = ses.build_email_body(account_id, mock_app_service_dict, mock_app_s3_usage_dict)
     print(html)
     print(text)
+
+
+def test_email_body_changes(mocker, mock_app_service_dict, mock_app_s3_usage_dict):
+    account_id = 'ACCOUNT_ID'
+    last_period = {"Start": "2022-12-01", "End": "2023-01-01"}
+    last_changes = {
+        "services": {
+            "ec2": {"total": 300, "previous": 200, "change": 0.5},
+        },
+        "s3_usage": {},
+    }
+
+    env_vars = {
+        "MINIMUM": "0.01"
+    }
+    mocker.patch.dict(os.environ, env_vars)
+
+    html, text = ses.build_email_body(
+        account_id,
+        mock_app_service_dict,
+        mock_app_s3_usage_dict,
+        last_period,
+        last_changes,
+    )
+    assert "Changes since the last report for December 2022:" in text
+    assert "<th>Last Report</th>" in html
+    assert "S3 Usage Type\tLast Report" not in text
+
+
+def test_service_table_forecast(mock_app_service_dict):
+    services = dict(mock_app_service_dict)
+    first = next(iter(services))
+    services[first] = {**services[first], "forecast": 123450000000}
+
+    text = ses.build_service_table(services, False)
+    lines = text.splitlines()
+    assert lines[0].endswith("\tCurrent Month Forecast")
+    assert lines[1].endswith("\t$12.35")
+    assert lines[2].endswith("\t")
+
+    html = ses.build_service_table(services, True)
+    assert "<th>Current Month Forecast</th>" in html
+
+    # no forecast column without any forecasts
+    text = ses.build_service_table(mock_app_service_dict, False)
+    assert "Forecast" not in text
+
+
+def test_report_body_sections(mocker, mock_app_service_dict):
+    env_vars = {
+        "MINIMUM": "0.01"
+    }
+    mocker.patch.dict(os.environ, env_vars)
+
+    projects = sections.Section(
+        name="projects",
+        title="Break-down of total monthly costs by project:",
+        header="Project",
+        group_by={"Type": "TAG", "Key": "Project"},
+    )
+    report_sections = [sections.SERVICES, sections.S3_USAGE, projects]
+    data = {
+        "services": mock_app_service_dict,
+        "s3_usage": {},
+        "projects": {"": {"total": 50000000000, "change": 1.0}},
+    }
+
+    html, text = ses.build_report_body("ACCOUNT_ID", report_sections, data)
+
+    assert "No data found for S3 usage totals" in text
+    assert "Break-down of total monthly costs by project:" in text
+    assert "Project\tTotal" in text
+    assert "(no Project)\t$5.00" in text
+    assert "<td>(no Project)</td>" in html
+
+
+def test_tag_values_escaped():
+    projects = sections.Section(
+        name="projects",
+        title="Break-down of total monthly costs by project:",
+        header="Project",
+        group_by={"Type": "TAG", "Key": "Project"},
+    )
+    tag_value = "<a href='http://x'>click</a>"
+    costs = {tag_value: {"total": 50000000000, "change": 1.0}}
+    changes = {tag_value: {"total": 50000000000, "previous": 0, "change": 1.0}}
+
+    html = ses.build_report_body(
+        "ACCOUNT_ID",
+        [projects],
+        {"projects": costs},
+        {"Start": "2022-12-01", "End": "2023-01-01"},
+        {"projects": changes},
+    )[0]
+
+    assert "<a href" not in html
+    assert html.count("&lt;a href=&#x27;http://x&#x27;&gt;click&lt;/a&gt;") == 2
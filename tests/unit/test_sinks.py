@@ -0,0 +1,189 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from botocore.stub import Stubber
+
+from s3_cost_report import ses, sinks, snapshots
+
+report = sinks.Report("2023-01-01", "Report: Test Month", "<html>test</html>", "test\n")
+
+
+class FailingSink(sinks.Sink):
+    """Fail a number of times before succeeding"""
+
+    name = "failing"
+
+    def __init__(self, failures, **kwargs):
+        super().__init__(backoff=0.01, **kwargs)
+        self.failures = failures
+        self.attempts = 0
+
+    def send(self, report, timeout):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise ConnectionError("test failure")
+
+
+class SlowSink(sinks.Sink):
+    """Take longer than the timeout"""
+
+    name = "slow"
+
+    def send(self, report, timeout):
+        time.sleep(5)
+
+
+@pytest.fixture()
+def webhook_server():
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers["Content-Length"])
+            received.append(json.loads(self.rfile.read(length)))
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f"http://127.0.0.1:{server.server_port}/hook", received
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_webhook_sink(webhook_server):
+    url, received = webhook_server
+
+    found = sinks.dispatch([sinks.WebhookSink(url)], report)
+
+    assert found == {"webhook": True}
+    assert received == [{"text": "*Report: Test Month*\n```\ntest\n```"}]
+
+
+def test_store_sink(tmp_path):
+    sink = sinks.StoreSink(snapshots.FileStore(tmp_path))
+
+    found = sinks.dispatch([sink], report)
+
+    assert found == {"store": True}
+    assert (tmp_path / "2023-01-01.html").read_text() == report.html
+    assert (tmp_path / "2023-01-01.txt").read_text() == report.text
+
+
+def test_ses_sink(mocker, mock_ses_response):
+    env_vars = {
+        "RECIPIENTS": "admin@example.com",
+        "SENDER": "test@example.com",
+    }
+    mocker.patch.dict(os.environ, env_vars)
+
+    with Stubber(ses.ses_client) as _stub:
+        _stub.add_response("send_email", mock_ses_response)
+
+        found = sinks.dispatch([sinks.SesSink()], report)
+        assert found == {"ses": True}
+
+        _stub.assert_no_pending_responses()
+
+
+def test_retry():
+    sink = FailingSink(failures=2, retries=2)
+
+    found = sinks.dispatch([sink], report)
+
+    assert found == {"failing": True}
+    assert sink.attempts == 3
+
+
+def test_retries_exhausted():
+    sink = FailingSink(failures=5, retries=1)
+
+    found = sinks.dispatch([sink], report)
+
+    assert isinstance(found["failing"], ConnectionError)
+    assert sink.attempts == 2
+
+
+def test_slow_sink_does_not_block_others(tmp_path, webhook_server):
+    url, received = webhook_server
+    outputs = [
+        SlowSink(timeout=0.2),
+        sinks.WebhookSink(url),
+        sinks.StoreSink(snapshots.FileStore(tmp_path)),
+    ]
+
+    start = time.monotonic()
+    found = sinks.dispatch(outputs, report)
+    elapsed = time.monotonic() - start
+
+    assert isinstance(found["slow"], TimeoutError)
+    assert found["webhook"] is True
+    assert found["store"] is True
+    assert len(received) == 1
+
+    # bounded by the slow sink's timeout, not its run time
+    assert elapsed < 2
+
+
+def test_overall_deadline():
+    sink = SlowSink(timeout=30)
+
+    start = time.monotonic()
+    found = sinks.dispatch([sink], report, start + 0.2)
+
+    # the overall deadline cuts the sink's own timeout short
+    assert isinstance(found["slow"], TimeoutError)
+    assert time.monotonic() - start < 2
+
+
+def test_queue_full():
+    sink = SlowSink(timeout=0.1)
+
+    # the first report occupies the worker, the second fills the queue
+    sink.submit(report, time.monotonic() + 10)
+    time.sleep(0.05)
+    sink.submit(report, time.monotonic() + 10)
+
+    found = sinks.dispatch([sink], report)
+    assert isinstance(found["slow"], RuntimeError)
+
+
+def test_from_environment(mocker, tmp_path):
+    mocker.patch.dict(os.environ, {}, clear=True)
+    assert sinks.from_environment() == []
+
+    env_vars = {
+        "RECIPIENTS": "admin@example.com",
+        "WEBHOOK_URL": "http://127.0.0.1/hook",
+        "REPORT_DIR": str(tmp_path),
+    }
+    mocker.patch.dict(os.environ, env_vars)
+
+    found = [sink.name for sink in sinks.from_environment()]
+    assert found == ["ses", "webhook", "store"]
+
+
+def test_sinks_reused(mocker, tmp_path):
+    mocker.patch.dict(os.environ, {"REPORT_DIR": str(tmp_path)}, clear=True)
+
+    first = sinks.from_environment()
+    sinks.dispatch(first, report)
+    threads = threading.active_count()
+
+    # later runs in a warm container reuse the sink and its worker thread
+    for _ in range(5):
+        found = sinks.from_environment()
+        assert sinks.dispatch(found, report) == {"store": True}
+        assert found[0] is first[0]
+
+    assert threading.active_count() == threads
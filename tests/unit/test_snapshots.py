@@ -0,0 +1,116 @@
+import gzip
+import io
+
+import pytest
+from botocore.stub import Stubber
+
+from s3_cost_report import snapshots
+
+december = {"Start": "2022-12-01", "End": "2023-01-01"}
+january = {"Start": "2023-01-01", "End": "2023-02-01"}
+february = {"Start": "2023-02-01", "End": "2023-03-01"}
+
+december_sections = {
+    "services": {"ec2": 200, "rds": 50},
+    "s3_usage": {"type1": 10},
+}
+january_sections = {
+    "services": {"ec2": 300, "s3": 100},
+    "s3_usage": {"type1": 10},
+}
+
+
+def test_encode_decode():
+    data = snapshots.encode_snapshot(january, january_sections)
+
+    # the snapshot is compressed and stored as columns
+    assert b'"keys":["ec2","s3"],"totals":[300,100]' in gzip.decompress(data)
+
+    period, sections = snapshots.decode_snapshot(data)
+    assert period == january
+    assert sections == january_sections
+
+
+def test_decode_unsupported_version():
+    data = gzip.compress(b'{"version": 0}')
+
+    with pytest.raises(ValueError):
+        snapshots.decode_snapshot(data)
+
+
+@pytest.fixture(params=["file", "memory"])
+def store(request, tmp_path):
+    if request.param == "file":
+        return snapshots.SnapshotStore(snapshots.FileStore(tmp_path / "snapshots"))
+    return snapshots.SnapshotStore(snapshots.MemoryStore())
+
+
+def test_snapshot_store(store):
+    assert store.latest(january) is None
+    assert store.load(january) is None
+
+    store.save(december, december_sections)
+    store.save(january, january_sections)
+
+    assert store.load(january) == (january, january_sections)
+
+    # only earlier periods are considered
+    assert store.latest(january) == (december, december_sections)
+    assert store.latest(february) == (january, january_sections)
+
+
+def test_s3_store():
+    backend = snapshots.S3Store("test-bucket", "snapshots/")
+    data = snapshots.encode_snapshot(january, january_sections)
+
+    with Stubber(snapshots.s3_client) as _stub:
+        _stub.add_response(
+            "put_object",
+            {},
+            {"Bucket": "test-bucket", "Key": "snapshots/2023-01-01.json.gz", "Body": data},
+        )
+        _stub.add_response(
+            "list_objects_v2",
+            {"Contents": [{"Key": "snapshots/2023-01-01.json.gz"}]},
+            {"Bucket": "test-bucket", "Prefix": "snapshots/"},
+        )
+        _stub.add_response(
+            "get_object",
+            {"Body": io.BytesIO(data)},
+            {"Bucket": "test-bucket", "Key": "snapshots/2023-01-01.json.gz"},
+        )
+        _stub.add_client_error("get_object", service_error_code="NoSuchKey")
+
+        store = snapshots.SnapshotStore(backend)
+        store.save(january, january_sections)
+        assert store.latest(february) == (january, january_sections)
+        assert store.load(december) is None
+
+        _stub.assert_no_pending_responses()
+
+
+def test_from_environment(mocker, tmp_path):
+    mocker.patch.dict("os.environ", {}, clear=True)
+    assert snapshots.from_environment() is None
+
+    mocker.patch.dict("os.environ", {"SNAPSHOT_DIR": str(tmp_path)})
+    found = snapshots.from_environment()
+    assert isinstance(found.backend, snapshots.FileStore)
+
+    mocker.patch.dict("os.environ", {"SNAPSHOT_BUCKET": "test-bucket"})
+    found = snapshots.from_environment()
+    assert isinstance(found.backend, snapshots.S3Store)
+    assert found.backend.prefix == "snapshots/"
+
+
+def test_diff_sections():
+    found = snapshots.diff_sections(january_sections, december_sections)
+
+    assert found == {
+        "services": {
+            "ec2": {"total": 300, "previous": 200, "change": 0.5},
+            "s3": {"total": 100, "previous": 0, "change": 1.0},
+            "rds": {"total": 0, "previous": 50, "change": -1.0},
+        },
+        "s3_usage": {},
+    }